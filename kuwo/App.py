@@ -56,6 +56,7 @@ class App:
 
     def on_app_startup(self, app):
         self.conf = Config.load_conf()
+        Net.apply_conf(self.conf)
         self.icon_theme = Gtk.IconTheme.get_default()
         self.icon_theme.append_search_path(Config.ICON_PATH)
 
@@ -106,6 +107,21 @@ class App:
         # Cleanup temporary media files
         Net.cleanup_temp_files(self.conf['song-dir'])
         Net.cleanup_temp_files(self.conf['mv-dir'])
+        Net.start_cache_maintenance()
+        Net.start_network_monitor()
+        GLib.timeout_add_seconds(Net.QUOTA_INTERVAL, self.check_disk_quotas)
+
+    def check_disk_quotas(self):
+        '''Remove old cached files in background.
+
+        Songs in playlists or being played are collected here in main
+        thread, as liststores are not thread safe.
+        '''
+        protected = set(self.playlist.get_protected_paths())
+        protected.update(self.player.get_protected_paths())
+        Net.async_call(Net.enforce_quotas, protected,
+                       priority=Net.Priority.PREFETCH)
+        return True
 
     def on_app_shutdown(self, app):
         Config.dump_conf(self.conf)
@@ -407,7 +407,8 @@ class Artists(Gtk.Box):
                 urls.append(artist['pic'])
                 tree_iters.append(tree_iter)
             Net.async_call(Net.update_artist_logos, self.artists_liststore, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
 
         if init:
             self.artists_win.get_vscrollbar().set_value(0)
@@ -547,7 +548,8 @@ class Artists(Gtk.Box):
                 urls.append(album['pic'])
                 tree_iters.append(tree_iter)
             Net.async_call(Net.update_album_covers,
-                           self.artist_albums_liststore, 0, tree_iters, urls)
+                           self.artist_albums_liststore, 0, tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
             self.artist_albums_page += 1
             if self.artist_albums_page < self.artist_albums_total - 1:
                 self.append_artist_albums()
@@ -593,7 +595,8 @@ class Artists(Gtk.Box):
                 tree_iters.append(tree_iter)
                 urls.append(mv['pic'])
             Net.async_call(Net.update_mv_images, self.artist_mv_liststore, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
             self.artist_mv_page += 1
             if self.artist_mv_page < self.artist_mv_total - 1:
                 self.append_artist_mv()
@@ -638,7 +641,8 @@ class Artists(Gtk.Box):
                 urls.append(artist['pic'])
                 tree_iters.append(tree_iter)
             Net.async_call(Net.update_artist_logos,
-                           self.artist_similar_liststore, 0, tree_iters, urls)
+                           self.artist_similar_liststore, 0, tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
             self.artist_similar_page += 1
             if self.artist_similar_page < self.artist_similar_total - 1:
                 self.append_artist_similar()
@@ -667,8 +671,8 @@ class Artists(Gtk.Box):
             if error or not info:
                 logger.error('appen_artist_info(): %s, %s' % (info, error))
                 return
-            if info.get('pic', None):
-                self.artist_info_pic.set_from_file(info['pic'])
+            if info.get('pixbuf', None):
+                self.artist_info_pic.set_from_pixbuf(info['pixbuf'])
             self.artist_info_name.set(info, 'name')
             self.artist_info_birthday.set(info, 'birthday')
             self.artist_info_birthplace.set(info, 'birthplace')
@@ -758,11 +762,10 @@ class Artists(Gtk.Box):
             if error or not info:
                 logger.error('add_to_fav_artists(): %s, %s' % (info, error))
                 return
-            if info.get('pic', None):
-                pix = GdkPixbuf.Pixbuf.new_from_file_at_size(info['pic'],
-                                                             100, 100)
+            if info.get('pixbuf', None):
+                pix = info['pixbuf']
             else:
-                pix = Config.ANONYMOUS_PIXBUF,
+                pix = Config.ANONYMOUS_PIXBUF
             tip = Widgets.escape(info.get('info', ''))
             self.fav_artists_liststore.append([pix, info['name'],
                                                artist_id, tip])
@@ -0,0 +1,1034 @@
+
+# Copyright (C) 2013-2014 LiuLang <gsushzhsosgsu@gmail.com>
+
+# Use of this source code is governed by GPLv3 license that can be found
+# in the LICENSE file.
+
+import atexit
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from kuwo.log import logger
+
+try:
+    # Debian: http://code.google.com/p/py-leveldb/
+    import leveldb
+    ldb_imported = True
+except ImportError:
+    logger.debug(traceback.format_exc())
+    ldb_imported = False
+
+CACHE_TIMEOUT = 1209600      # 14 days in seconds
+CACHE_SIZE = 67108864        # 64M, disk budget of cached responses
+MEM_CACHE_SIZE = 16777216    # 16M, memory budget of parsed responses
+TS_LEN = 10                  # length of timestamp prefix in LevelDB value
+BATCH_SIZE = 32              # max num of pending writes in SQLite backend
+BATCH_TIMEOUT = 5            # flush pending writes after 5 seconds
+
+def parse_timestamp(value):
+    '''Get timestamp prefix of a value, returns 0 if it is invalid.'''
+    try:
+        return int(bytes(value[:TS_LEN]).decode())
+    except (ValueError, UnicodeDecodeError):
+        return 0
+
+
+class CacheBackend:
+    '''Storage interface used by CacheStore.
+
+    Keys are bytes, each entry has a timestamp (when it was written) and
+    content. Size of an entry is the length of its content.
+    Backends need to be thread safe.
+    '''
+
+    def get(self, key):
+        '''Returns (timestamp, content), or None if key is not found.'''
+        raise NotImplementedError
+
+    def put(self, key, timestamp, content):
+        raise NotImplementedError
+
+    def delete(self, keys):
+        raise NotImplementedError
+
+    def scan(self):
+        '''Iterate all entries, yields (key, size, timestamp).'''
+        raise NotImplementedError
+
+    def compact(self):
+        '''Reclaim disk space of deleted entries.'''
+        pass
+
+    def flush(self):
+        '''Write pending changes to disk.'''
+        pass
+
+
+class LevelDBBackend(CacheBackend):
+    '''Entries stored in LevelDB.
+
+    Value is a 10 bytes ASCII timestamp + content, the same as older
+    versions, so existing caches keep working.
+    '''
+
+    def __init__(self, path):
+        self.db = leveldb.LevelDB(path, create_if_missing=True)
+
+    def get(self, key):
+        try:
+            value = self.db.Get(key)
+        except KeyError:
+            return None
+        if len(value) <= TS_LEN:
+            return None
+        return (parse_timestamp(value), bytes(value[TS_LEN:]))
+
+    def put(self, key, timestamp, content):
+        self.db.Put(key, str(timestamp).encode() + content)
+
+    def delete(self, keys):
+        batch = leveldb.WriteBatch()
+        for key in keys:
+            batch.Delete(key)
+        self.db.Write(batch, sync=False)
+
+    def scan(self):
+        for key, value in self.db.RangeIter():
+            yield (bytes(key), len(value) - TS_LEN, parse_timestamp(value))
+
+    def compact(self):
+        self.db.CompactRange()
+
+
+class SQLiteBackend(CacheBackend):
+    '''Entries stored in SQLite, used when leveldb is unavailable.
+
+    Database runs in WAL mode. Writes are kept in memory and committed in
+    one transaction when BATCH_SIZE of them are pending, or by a timer
+    BATCH_TIMEOUT seconds after the first of them.
+    '''
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None)
+        self.lock = threading.Lock()
+        # key -> (timestamp, content), or None if key is deleted
+        self.pending = {}
+        # commits pending writes, started with the first of them
+        self.timer = None
+        with self.lock:
+            # auto_vacuum only takes effect when db is created.
+            self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS cache (
+                key BLOB PRIMARY KEY,
+                timestamp INTEGER NOT NULL,
+                content BLOB NOT NULL)''')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            row = self.conn.execute(
+                    'SELECT timestamp, content FROM cache WHERE key = ?',
+                    (key, )).fetchone()
+        if not row:
+            return None
+        return (row[0], bytes(row[1]))
+
+    def put(self, key, timestamp, content):
+        with self.lock:
+            self.set_pending(key, (timestamp, content))
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                self.set_pending(key, None)
+
+    def set_pending(self, key, entry):
+        '''Called with self.lock held.'''
+        if not self.pending:
+            self.timer = threading.Timer(BATCH_TIMEOUT, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+        self.pending[key] = entry
+        if len(self.pending) >= BATCH_SIZE:
+            self.commit()
+
+    def commit(self):
+        '''Called with self.lock held.'''
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        puts = [(key, entry[0], entry[1]) for key, entry in
+                self.pending.items() if entry]
+        deletes = [(key, ) for key, entry in self.pending.items()
+                   if not entry]
+        self.pending = {}
+        try:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('''INSERT OR REPLACE INTO cache
+                (key, timestamp, content) VALUES (?, ?, ?)''', puts)
+            self.conn.executemany('DELETE FROM cache WHERE key = ?',
+                                  deletes)
+            self.conn.execute('COMMIT')
+        except sqlite3.Error:
+            logger.error(traceback.format_exc())
+            if self.conn.in_transaction:
+                self.conn.execute('ROLLBACK')
+
+    def flush(self):
+        with self.lock:
+            self.commit()
+
+    def scan(self):
+        self.flush()
+        with self.lock:
+            rows = self.conn.execute(
+                    'SELECT key, length(content), timestamp FROM cache'
+                    ).fetchall()
+        for key, size, timestamp in rows:
+            yield (bytes(key), size, timestamp)
+
+    def compact(self):
+        with self.lock:
+            self.commit()
+            self.conn.execute('PRAGMA incremental_vacuum')
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+class CacheStore:
+    '''HTTP responses cached on disk, bounded in disk usage.
+
+    Entries are kept in a CacheBackend. An in-memory index keeps size and
+    last access time of each entry. When the store grows larger than
+    `max_size`, least recently used entries are removed. Expired entries
+    are removed and the db is compacted by maintain(), which runs in
+    background. All backends share these semantics.
+    '''
+
+    def __init__(self, backend, max_size=CACHE_SIZE, timeout=CACHE_TIMEOUT):
+        '''timeout - seconds entries are kept in store.'''
+        self.backend = backend
+        self.max_size = max_size
+        self.timeout = timeout
+        # key -> [size, timestamp], least recently used entries first
+        self.index = collections.OrderedDict()
+        self.index_loaded = False
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.deleted_since_compact = 0
+        self.lock = threading.Lock()
+
+    def load_index(self):
+        '''Scan the whole db once to build index, run in background.'''
+        entries = list(self.backend.scan())
+        # There is no access time on disk, use write time instead.
+        entries.sort(key=lambda entry: entry[2])
+        with self.lock:
+            # entries touched while scanning are the most recently used.
+            touched = self.index
+            self.index = collections.OrderedDict()
+            for key, size, timestamp in entries:
+                if key not in touched:
+                    self.index[key] = [size, timestamp]
+            self.index.update(touched)
+            self.size = sum(item[0] for item in self.index.values())
+            self.index_loaded = True
+        self.evict()
+
+    def get(self, key, ttl=None):
+        '''Returns (content, expired), or None if key is not cached.
+
+        ttl - seconds an entry stays fresh, default is self.timeout.
+        Expired entries are still returned, callers decide whether to
+        use them. Entries older than self.timeout are never returned,
+        they are about to be removed by maintain().
+        '''
+        if ttl is None:
+            ttl = self.timeout
+        entry = self.backend.get(key)
+        if (not entry or not entry[1] or
+                time.time() - entry[0] >= self.timeout):
+            with self.lock:
+                self.misses += 1
+            return None
+        timestamp, content = entry
+        expired = time.time() - timestamp >= ttl
+        with self.lock:
+            if expired:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            if key in self.index:
+                self.index.move_to_end(key)
+            else:
+                self.index[key] = [len(content), timestamp]
+                self.size += len(content)
+        return (content, expired)
+
+    def put(self, key, content):
+        timestamp = int(time.time())
+        self.backend.put(key, timestamp, content)
+        with self.lock:
+            item = self.index.pop(key, None)
+            if item:
+                self.size -= item[0]
+            self.index[key] = [len(content), timestamp]
+            self.size += len(content)
+            over_budget = self.size > self.max_size
+        if over_budget:
+            self.evict()
+
+    def delete(self, keys):
+        if not keys:
+            return
+        self.backend.delete(keys)
+        with self.lock:
+            self.deleted_since_compact += len(keys)
+
+    def evict(self):
+        '''Remove least recently used entries if store is over budget.
+
+        Removes a bit more than needed, so that eviction does not happen
+        on every put().
+        '''
+        keys = []
+        with self.lock:
+            # Index is incomplete, do not remove recently used entries.
+            if not self.index_loaded or self.size <= self.max_size:
+                return
+            target = self.max_size * 0.9
+            while self.index and self.size > target:
+                key, item = self.index.popitem(last=False)
+                self.size -= item[0]
+                keys.append(key)
+            self.evicted += len(keys)
+        self.delete(keys)
+
+    def maintain(self):
+        '''Remove expired entries, enforce size budget and compact db.'''
+        self.backend.flush()
+        if not self.index_loaded:
+            return
+        expire_time = time.time() - self.timeout
+        with self.lock:
+            keys = [key for key, item in self.index.items()
+                    if item[1] < expire_time]
+            for key in keys:
+                self.size -= self.index.pop(key)[0]
+            self.evicted += len(keys)
+        self.delete(keys)
+        self.evict()
+        if self.deleted_since_compact > 0:
+            self.backend.compact()
+            with self.lock:
+                self.deleted_since_compact = 0
+        logger.info('Cache.maintain(): %s' % self.stats())
+
+    def flush(self):
+        self.backend.flush()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': self.backend.__class__.__name__,
+                'hits': self.hits,
+                'stale-hits': self.stale_hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+                'entries': len(self.index),
+                'size': self.size,
+                'max-size': self.max_size,
+            }
+
+
+class MemoryCache:
+    '''Parsed responses kept in memory, in front of CacheStore.
+
+    Each entry has a cost, an estimate of its memory usage, like the
+    length of the response it was parsed from. When total cost grows
+    larger than `max_size`, least recently used entries are removed.
+    Values may be None, which means the request failed.
+    '''
+
+    def __init__(self, max_size=MEM_CACHE_SIZE):
+        self.max_size = max_size
+        # key -> (expire time, cost, value), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns (True, value) if key is cached, else (False, None).'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or entry[0] <= time.time():
+                self.misses += 1
+                return (False, None)
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return (True, entry[2])
+
+    def put(self, key, value, cost, ttl=None):
+        '''ttl - seconds to keep this entry, None means no time limit.'''
+        if ttl is None:
+            expire_time = float('inf')
+        else:
+            expire_time = time.time() + ttl
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.size -= entry[1]
+            self.entries[key] = (expire_time, cost, value)
+            self.size += cost
+            while self.size > self.max_size and self.entries:
+                self.size -= self.entries.popitem(last=False)[1][1]
+                self.evicted += 1
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.size -= entry[1]
+
+    def prune(self):
+        '''Remove expired entries.'''
+        now = time.time()
+        with self.lock:
+            keys = [key for key, entry in self.entries.items()
+                    if entry[0] <= now]
+            for key in keys:
+                self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+                'entries': len(self.entries),
+                'size': self.size,
+                'max-size': self.max_size,
+            }
+
+
+def is_cached_file(path, exts=None):
+    '''Whether path is a cached file, instead of a temporary one.
+
+    exts - extensions accepted, default is None, all of them.
+    '''
+    if path.endswith('.part') or path.endswith('.json'):
+        return False
+    if exts:
+        return os.path.splitext(path)[1].lower() in exts
+    return True
+
+def scan_files(path, entries, recursive=False):
+    '''Append (path, size, last access) of files in path to entries.'''
+    try:
+        dir_entries = list(os.scandir(path))
+    except OSError:
+        logger.warn(traceback.format_exc())
+        return
+    for entry in dir_entries:
+        try:
+            if entry.is_dir():
+                if recursive:
+                    scan_files(entry.path, entries, recursive)
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_size,
+                                max(stat.st_atime, stat.st_mtime)))
+        except OSError:
+            logger.warn(traceback.format_exc())
+
+
+class DiskQuota:
+    '''Size and last access time of files in a cache directory.
+
+    Files are scanned once by load_index(), then kept up to date by add()
+    and touch(), without stat calls. When total size of files grows
+    larger than `max_size`, evict() removes least recently used ones.
+
+    root      - the directory, its subdirectories are scanned too if
+                `recursive` is True.
+    max_size  - in bytes, 0 means no limit.
+    exts      - only files with these extensions are managed, default is
+                None, all files except temporary files.
+    on_remove - called with path of each removed file.
+    owns      - called with path of a file, returns False if the file was
+                not saved by kwplayer and must never be removed, like
+                music of user in song folder. Default is None, all files
+                in root are owned.
+    '''
+
+    def __init__(self, root=None, max_size=0, recursive=False, exts=None,
+                 on_remove=None, owns=None):
+        self.root = root
+        self.max_size = max_size
+        self.recursive = recursive
+        self.exts = exts
+        self.on_remove = on_remove
+        self.owns = owns
+        # path -> size, least recently used files first
+        self.files = collections.OrderedDict()
+        self.size = 0
+        self.evicted = 0
+        self.index_loaded = False
+        self.lock = threading.Lock()
+
+    def set_root(self, root):
+        '''Returns True if root changed, index needs to be loaded again.'''
+        with self.lock:
+            if root == self.root:
+                return False
+            self.root = root
+            self.files.clear()
+            self.size = 0
+            self.index_loaded = False
+        return True
+
+    def accepts(self, path):
+        return is_cached_file(path, self.exts)
+
+    def load_index(self, entries=None):
+        '''Scan root, run in background.
+
+        entries - list of (path, size, last access), if the caller has
+                  scanned the directory already.
+        '''
+        root = self.root
+        if entries is None:
+            entries = []
+            scan_files(root, entries, self.recursive)
+        entries = [entry for entry in entries if self.accepts(entry[0])]
+        entries.sort(key=lambda entry: entry[2])
+        with self.lock:
+            if root != self.root:
+                return
+            # files touched while scanning are the most recently used.
+            touched = self.files
+            self.files = collections.OrderedDict()
+            for path, size, atime in entries:
+                if path not in touched:
+                    self.files[path] = size
+            self.files.update(touched)
+            self.size = sum(self.files.values())
+            self.index_loaded = True
+
+    def add(self, path, size=None):
+        '''A file is created or replaced.'''
+        if not self.accepts(path):
+            return
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+        with self.lock:
+            self.size -= self.files.pop(path, 0)
+            self.files[path] = size
+            self.size += size
+
+    def touch(self, path):
+        '''A file is used.'''
+        with self.lock:
+            if path in self.files:
+                self.files.move_to_end(path)
+
+    def discard(self, path):
+        '''A file is removed by others.'''
+        with self.lock:
+            self.size -= self.files.pop(path, 0)
+
+    def evict(self, protected=()):
+        '''Remove least recently used files if over quota.
+
+        protected - file paths which are never removed; files sharing
+                    a name with them but with another extension are kept
+                    too, like song.mp3 and song.flac.
+        Returns num of removed files.
+        '''
+        protected_names = {os.path.splitext(path)[0] for path in protected}
+        paths = []
+        with self.lock:
+            if (not self.max_size or not self.index_loaded or
+                    self.size <= self.max_size):
+                return 0
+            target = self.max_size * 0.9
+            size = self.size
+            for path, file_size in self.files.items():
+                if size <= target:
+                    break
+                if os.path.splitext(path)[0] in protected_names:
+                    continue
+                if self.owns and not self.owns(path):
+                    continue
+                paths.append(path)
+                size -= file_size
+        removed = 0
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logger.warn(traceback.format_exc())
+                continue
+            self.discard(path)
+            removed += 1
+            if self.on_remove:
+                self.on_remove(path)
+        with self.lock:
+            self.evicted += removed
+        return removed
+
+    def stats(self):
+        with self.lock:
+            return {
+                'root': self.root,
+                'evicted': self.evicted,
+                'files': len(self.files),
+                'size': self.size,
+                'max-size': self.max_size,
+            }
+
+
+class ImageStore:
+    '''Images saved in hash-sharded directories.
+
+    Image of url is saved as root/ab/abcdef...ext, named by sha1 of its
+    url, so that images from different CDN paths never collide and no
+    directory grows too large. File names are scanned once by
+    load_index(), after that lookups are dict lookups, without stat().
+
+    Older versions saved images directly in root, named by the basename
+    of url (or by sha1 of url). Those files are moved into shards by
+    load_index() or when they are looked up.
+
+    Thumbnails scaled down to a display size are saved next to the
+    originals, named by sha1 of url#size.
+
+    Disk usage is limited by self.quota.
+    '''
+
+    def __init__(self, root, max_size=0):
+        self.root = root
+        self.quota = DiskQuota(root, max_size, recursive=True,
+                               on_remove=self.discard)
+        # sha1 of url -> file path
+        self.index = {}
+        # basename -> file path, images saved by older versions
+        self.legacy = {}
+        self.index_loaded = False
+        self.lock = threading.Lock()
+
+    def get_key(self, url, size=0):
+        '''size - size of thumbnail, 0 means the original image.'''
+        if size:
+            url = '{0}#{1}'.format(url, size)
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def get_path(self, url, size=0):
+        '''Get path of image of url, even if it is not stored.'''
+        key = self.get_key(url, size)
+        ext = os.path.splitext(os.path.basename(url))[1][:8]
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def lookup(self, url, size=0):
+        '''Returns file path if image of url is stored, else None.
+
+        size - size of thumbnail, 0 means the original image.
+        '''
+        key = self.get_key(url, size)
+        with self.lock:
+            filepath = self.index.get(key)
+            if filepath or self.index_loaded and (size or not self.legacy):
+                if filepath:
+                    self.quota.touch(filepath)
+                return filepath
+            index_loaded = self.index_loaded
+            legacy_path = None
+            if not size:
+                legacy_path = self.legacy.pop(os.path.basename(url), None)
+        if not index_loaded:
+            # index is not ready yet
+            filepath = self.get_path(url, size)
+            if os.path.exists(filepath):
+                self.add(key, filepath)
+                return filepath
+            if size:
+                return None
+            legacy_path = os.path.join(self.root, os.path.basename(url))
+            if not os.path.isfile(legacy_path):
+                return None
+        if legacy_path:
+            return self.migrate(key, legacy_path, self.get_path(url))
+        return None
+
+    def put(self, url, content, size=0):
+        '''Save image content, returns its file path.
+
+        size - content is a thumbnail of this size, 0 means the original.
+        '''
+        filepath = self.get_path(url, size)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_path = filepath + '.part'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(content)
+        os.rename(tmp_path, filepath)
+        self.add(self.get_key(url, size), filepath, len(content))
+        return filepath
+
+    def add(self, key, filepath, size=None):
+        with self.lock:
+            self.index[key] = filepath
+        self.quota.add(filepath, size)
+
+    def discard(self, filepath):
+        '''Called when filepath is removed by self.quota.'''
+        key = os.path.splitext(os.path.basename(filepath))[0]
+        with self.lock:
+            if self.index.get(key) == filepath:
+                del self.index[key]
+
+    def migrate(self, key, old_path, filepath):
+        '''Move an image saved by older versions into its shard.'''
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            os.rename(old_path, filepath)
+        except OSError:
+            logger.warn(traceback.format_exc())
+            return None
+        self.quota.discard(old_path)
+        self.add(key, filepath)
+        return filepath
+
+    def load_index(self):
+        '''Scan all shards once, run in background.'''
+        index = {}
+        legacy = {}
+        # (path, size, last access) of all files, used by self.quota
+        files = []
+        try:
+            entries = list(os.scandir(self.root))
+        except OSError:
+            logger.error(traceback.format_exc())
+            entries = []
+        for entry in entries:
+            if entry.is_dir():
+                for shard_entry in os.scandir(entry.path):
+                    if shard_entry.name.endswith('.part'):
+                        continue
+                    key = os.path.splitext(shard_entry.name)[0]
+                    index[key] = shard_entry.path
+                    stat = shard_entry.stat()
+                    files.append((shard_entry.path, stat.st_size,
+                                  max(stat.st_atime, stat.st_mtime)))
+            elif entry.is_file():
+                legacy[entry.name] = entry.path
+                stat = entry.stat()
+                files.append((entry.path, stat.st_size,
+                              max(stat.st_atime, stat.st_mtime)))
+        # Files named by sha1 of their url can be moved at once.
+        moved = {}
+        for name, old_path in list(legacy.items()):
+            key, ext = os.path.splitext(name)
+            if len(key) != 40 or key in index:
+                continue
+            try:
+                int(key, 16)
+            except ValueError:
+                continue
+            del legacy[name]
+            filepath = os.path.join(self.root, key[:2], name)
+            try:
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                os.rename(old_path, filepath)
+                index[key] = filepath
+                moved[old_path] = filepath
+            except OSError:
+                logger.warn(traceback.format_exc())
+        with self.lock:
+            # images saved while scanning
+            index.update(self.index)
+            self.index = index
+            self.legacy = legacy
+            self.index_loaded = True
+        files = [(moved.get(path, path), size, atime) for
+                 path, size, atime in files]
+        self.quota.load_index(files)
+
+
+class LibraryIndex:
+    '''Songs and MVs cached locally, indexed by rid.
+
+    Each entry is a dict, saved in a json file:
+        {'rid': '928003', 'br': '320kmp3', 'format': 'mp3',
+         'path': '/home/user/.cache/kuwo/song/artist-name.mp3',
+         'size': 9862144}
+    `br` is the quality requested when downloading, `format` is the
+    extension of the file server sent. As files are found by rid instead
+    of by title, songs renamed on server are still found, and songs with
+    the same title are saved as different files.
+
+    load_index() scans roots once with os.scandir(). Files renamed on disk
+    are matched again by size and format. Files saved by older versions,
+    which have no rid, are kept as orphans, and adopted when a song with
+    the same file name is looked up.
+    '''
+
+    def __init__(self, filepath, exts=None):
+        self.filepath = filepath
+        self.exts = exts
+        self.roots = ()
+        # path -> entry
+        self.paths = {}
+        # rid -> list of entries
+        self.songs = {}
+        # path -> size, files without rid
+        self.orphans = {}
+        # paths added before index is loaded
+        self.added = set()
+        self.index_loaded = False
+        self.lock = threading.RLock()
+
+    def set_roots(self, roots):
+        '''Returns True if roots changed, index needs to be loaded again.'''
+        roots = tuple(sorted(set(roots)))
+        with self.lock:
+            if roots == self.roots:
+                return False
+            self.roots = roots
+            self.index_loaded = False
+        return True
+
+    def load_index(self):
+        '''Scan roots and check saved entries, run in background.
+
+        Returns a dict, root -> list of (path, size, last access) of
+        files in it, so that disk quotas need not scan them again.
+        '''
+        roots = self.roots
+        try:
+            with open(self.filepath) as fh:
+                saved = json.loads(fh.read())
+        except FileNotFoundError:
+            saved = []
+        except (OSError, ValueError):
+            logger.warn(traceback.format_exc())
+            saved = []
+        scanned = {}
+        for root in roots:
+            scanned[root] = []
+            scan_files(root, scanned[root])
+        # files not known by saved entries yet
+        unknown = {}
+        for entries in scanned.values():
+            for path, size, atime in entries:
+                if is_cached_file(path, self.exts):
+                    unknown[path] = size
+
+        with self.lock:
+            if roots != self.roots:
+                return {}
+            paths = {}
+            for entry in saved:
+                try:
+                    path = entry['path']
+                    if path not in unknown:
+                        path = self.find_renamed(entry, unknown)
+                        if not path:
+                            continue
+                    entry['path'] = path
+                    entry['size'] = unknown.pop(path)
+                    paths[path] = entry
+                except (KeyError, TypeError):
+                    continue
+            # files downloaded while scanning
+            for path in self.added:
+                if path in self.paths:
+                    unknown.pop(path, None)
+                    paths[path] = self.paths[path]
+            self.added.clear()
+            self.paths = paths
+            self.songs = {}
+            for entry in paths.values():
+                self.songs.setdefault(entry['rid'], []).append(entry)
+            self.orphans = unknown
+            self.index_loaded = True
+        self.dump()
+        return scanned
+
+    def find_renamed(self, entry, unknown):
+        '''Find the file of entry renamed by user, returns its new path.
+
+        Only a file in the same directory with the same format and size
+        is taken, if there is exactly one.
+        '''
+        dirname = os.path.dirname(entry['path'])
+        ext = '.' + entry['format']
+        paths = [path for path, size in unknown.items() if
+                 size == entry['size'] and path.endswith(ext) and
+                 os.path.dirname(path) == dirname]
+        if len(paths) == 1:
+            return paths[0]
+        return None
+
+    def find(self, rid, br, ext):
+        '''Get path of a song, prefer the one with the same quality.
+
+        A file with the same format but another quality is taken too.
+        Returns None if not found.
+        '''
+        with self.lock:
+            entries = self.songs.get(rid, ())
+            for entry in entries:
+                if entry['br'] == br:
+                    return entry['path']
+            for entry in entries:
+                if entry['format'] == ext:
+                    return entry['path']
+        return None
+
+    def adopt(self, rid, br, path):
+        '''Take a file without rid as the song, if it exists.
+
+        path is where older versions saved this song. Before the index
+        is loaded, disk is checked instead.
+        Returns True if the file exists.
+        '''
+        with self.lock:
+            if self.index_loaded:
+                size = self.orphans.pop(path, None)
+                if size is None:
+                    return False
+            else:
+                size = None
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return False
+        self.add(rid, br, path, size)
+        return True
+
+    def new_path(self, rid, dirname, name, ext):
+        '''Get path to save a song, which is not used by another song.'''
+        path = os.path.join(dirname, name + '.' + ext)
+        with self.lock:
+            entry = self.paths.get(path)
+            if not entry or entry['rid'] == rid:
+                return path
+        return os.path.join(dirname, '{0}-{1}.{2}'.format(name, rid, ext))
+
+    def contains(self, path):
+        '''Whether path is a song saved by kwplayer, with rid.'''
+        with self.lock:
+            return path in self.paths
+
+    def get_paths(self, rid):
+        with self.lock:
+            return [entry['path'] for entry in self.songs.get(rid, ())]
+
+    def add(self, rid, br, path, size):
+        '''A song is downloaded, or adopted.'''
+        entry = {
+            'rid': rid,
+            'br': br,
+            'format': os.path.splitext(path)[1][1:].lower(),
+            'path': path,
+            'size': size,
+        }
+        with self.lock:
+            self.remove_entry(path)
+            self.orphans.pop(path, None)
+            self.paths[path] = entry
+            self.songs.setdefault(rid, []).append(entry)
+            if not self.index_loaded:
+                self.added.add(path)
+        self.dump()
+
+    def discard(self, path):
+        '''A file is removed.'''
+        with self.lock:
+            self.orphans.pop(path, None)
+            self.added.discard(path)
+            found = self.remove_entry(path)
+        if found:
+            self.dump()
+
+    def remove_entry(self, path):
+        entry = self.paths.pop(path, None)
+        if not entry:
+            return False
+        entries = self.songs.get(entry['rid'], [])
+        if entry in entries:
+            entries.remove(entry)
+        if not entries:
+            self.songs.pop(entry['rid'], None)
+        return True
+
+    def dump(self):
+        with self.lock:
+            if not self.index_loaded:
+                # saved entries are not read yet
+                return
+            entries = list(self.paths.values())
+            content = json.dumps(entries)
+            tmp_path = self.filepath + '.part'
+            try:
+                with open(tmp_path, 'w') as fh:
+                    fh.write(content)
+                os.replace(tmp_path, self.filepath)
+            except OSError:
+                logger.error(traceback.format_exc())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'roots': self.roots,
+                'songs': len(self.songs),
+                'files': len(self.paths),
+                'orphans': len(self.orphans),
+            }
+
+
+def open_store(ldb_path, sqlite_path, max_size=CACHE_SIZE,
+               timeout=CACHE_TIMEOUT):
+    '''Open a CacheStore, prefer LevelDB and fallback to SQLite.
+
+    Returns None if no backend is available.
+    '''
+    backend = None
+    if ldb_imported:
+        try:
+            backend = LevelDBBackend(ldb_path)
+        except Exception:
+            logger.warn(traceback.format_exc())
+    if not backend:
+        try:
+            backend = SQLiteBackend(sqlite_path)
+        except sqlite3.Error:
+            logger.error(traceback.format_exc())
+            return None
+    store = CacheStore(backend, max_size, timeout)
+    # pending writes of SQLite backend
+    atexit.register(store.flush)
+    return store
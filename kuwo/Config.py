@@ -55,6 +55,10 @@ IMG_LARGE_DIR = os.path.join(CACHE_DIR, 'images_large')
 LRC_DIR = os.path.join(CACHE_DIR, 'lrc')
 # url requests are stored here.
 CACHE_DB = os.path.join(CACHE_DIR, 'cache.db')
+# used instead of CACHE_DB if leveldb is unavailable.
+CACHE_SQLITE = os.path.join(CACHE_DIR, 'cache.sqlite')
+# rid and path of songs and MVs cached locally.
+LIBRARY_JSON = os.path.join(CACHE_DIR, 'library.json')
 # store playlists, `cached` not included.
 PLS_JSON = os.path.join(CACHE_DIR, 'pls.json')
 # store radio playlist.
@@ -89,6 +93,17 @@ _default_conf = {
     'volume': 0.08,
     'audio': 2,  # 320k mp3
     'video': 1,  # mp4 high
+    'http-pool-size': 4,  # idle keep-alive connections kept for each host
+    'cache-db-size': 67108864,  # 64M, max size of cached responses
+    'cache-jobs': 3,  # songs downloaded at the same time by cache service
+    'bandwidth-limit': 0,  # KB/s, cap of background downloads, 0 no limit
+    'offline': False,  # offline mode, only local caches are used
+    # disk quotas in MB, 0 means no limit
+    'images-quota': 256,
+    'large-images-quota': 256,
+    'lrc-quota': 32,
+    'songs-quota': 0,
+    'mvs-quota': 0,
     'use-status-icon': True,
     'background-img-repeat': True,  # repeat background image to fill the window
     'background-img-size': 'cover',  # contain: background<=window, cover:background>=window
@@ -84,7 +84,8 @@ class MV(Gtk.Box):
                 urls.append(node['pic'])
             self.liststore_nodes.timestamp = time.time()
             Net.async_call(Net.update_liststore_images, self.liststore_nodes, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
         nid = 3
         Net.async_call(Net.get_index_nodes, nid, callback=_on_get_index_nodes)
 
@@ -119,7 +120,8 @@ class MV(Gtk.Box):
                 tree_iters.append(tree_iter)
                 urls.append(song['mvpic'])
             Net.async_call(Net.update_mv_images, self.liststore_songs, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
             self.songs_page += 1
             if self.songs_page < self.songs_total - 1:
                 self.append_songs()
@@ -4,24 +4,32 @@
 # Use of this source code is governed by GPLv3 license that can be found
 # in the LICENSE file.
 
+import base64
+import collections
 import hashlib
+import http.client
+import itertools
 import json
 import math
 import os
+import queue
 import re
 import sys
 import threading
 import time
 import traceback
+from urllib.error import HTTPError
 from urllib.error import URLError
 from urllib import parse
 from urllib import request
 
 from gi.repository import GdkPixbuf
+from gi.repository import Gio
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
 
+from kuwo import Cache
 from kuwo import Config
 from kuwo import DES
 from kuwo import Utils
@@ -38,42 +46,689 @@ SONG = 'http://antiserver.kuwo.cn/anti.s?'
 CHUNK = 16384                # 2**14, 16k, chunk size for file downloading 
 CHUNK_TO_PLAY = 2097152      # 2**21, 2M, min size to emit can-play signal
 CHUNK_MV_TO_PLAY = 8388608   # 2**23, 8M
+CHUNK_MIN_TO_PLAY = 262144   # 2**18, 256K, min size before playing
+THROUGHPUT_WINDOW = 5        # seconds of rolling download throughput
+THROUGHPUT_MIN_TIME = 0.5    # seconds, measure at least this long
+CAN_PLAY_MARGIN = 1.25       # download must be this faster than playback
+# Bitrates of audio formats, in kbps. Nominal bitrate of lossless is
+# 2000k, 1411k is the rate of CD audio, a upper bound of 16 bit flac.
+# Bitrate of MVs is unknown.
+BITRATES = {
+    '128kmp3': 128,
+    '192kmp3': 192,
+    '320kmp3': 320,
+    '2000kflac': 1411,
+}
+BANDWIDTH_TRICKLE = 32768    # 32K/s, for downloads waiting for others
+SEGMENT_SIZE = 2097152      # 2**21, 2M, byte range of segmented downloads
+SEGMENT_CONNS = 4            # connections used in segmented downloads
+SEEK_GAP = 524288            # 512K, fetch data after a seek if it is so far
+PART_EXT = '.part'           # partial file of songs and MVs
+PART_INFO_EXT = '.json'      # sidecar of partial file, to resume it
+PART_MAX_AGE = 1209600       # 14 days, partial files unused so long are removed
 RETRIES = 3                 # time to retry http connections
 TIMEOUT = 30                 # HTTP connection timeout
+POOL_SIZE = 4                # idle keep-alive connections kept per host
+REDIRECTS = 5                # max number of HTTP redirects to follow
+OFFLINE_FAILURES = 3         # a host is down after connections failed in a row
+OFFLINE_HOSTS = 3            # go offline if so many different hosts are down
+OFFLINE_RETRY = 60           # seconds, then let one request check it again
+WORKERS = 6                  # num of threads used by async_call()
+IMAGE_WORKERS = 8            # num of threads downloading thumbnails
+BACKGROUND_WORKERS = 2       # num of threads running PREFETCH jobs
+IMAGE_HOST_CONNS = 4         # max concurrent image downloads from one host
+DISPATCH_BUDGET = 0.008      # max seconds of main loop used by a batch
 SONG_NUM = 100               # num of songs in each request
 ICON_NUM = 50                # num of icons in each request
 CACHE_TIMEOUT = 1209600      # 14 days in seconds
+CACHE_MAX_STALE = 5184000    # 60 days, keep expired responses to revalidate
+CACHE_MAINTAIN_INTERVAL = 1800  # maintain cache.db every 30 minutes
+QUOTA_INTERVAL = 600         # check disk quotas every 10 minutes
+MB = 1048576                 # disk quotas in conf are in MB
+SONG_EXTS = ('.mp3', '.flac', '.aac', '.ape', '.m4a', '.wma')
+MV_EXTS = ('.mp4', )
 
 IMG_SIZE = 100               # image size, 100px
+PIXBUF_CACHE_SIZE = 33554432 # 32M, memory budget of decoded thumbnails
+
+# How responses of each endpoint are cached.
+#   ttl      - seconds a response stays fresh, 0 means never cache it
+#   persist  - keep it in cache.db, else only in memory for this session
+#   stale    - serve an expired response at once and refresh it in
+#              background (stale-while-revalidate), responses are kept
+#              CACHE_MAX_STALE seconds after they expired
+#   negative - seconds to remember a failed request, 0 means retry it
+#              every time
+CachePolicy = collections.namedtuple('CachePolicy',
+                                     ('ttl', 'persist', 'stale', 'negative'))
+CACHE_POLICIES = {
+    # browse views render from cache at once, even if it has expired.
+    'nodes': CachePolicy(CACHE_TIMEOUT, True, True, 0),
+    'album': CachePolicy(CACHE_TIMEOUT, True, True, 0),
+    'artists': CachePolicy(CACHE_TIMEOUT, True, True, 0),
+    'artist-info': CachePolicy(CACHE_TIMEOUT, True, False, 0),
+    'artist-albums': CachePolicy(CACHE_TIMEOUT, True, True, 0),
+    'artist-songs': CachePolicy(86400, True, False, 0),
+    'mv-songs': CachePolicy(86400, True, False, 0),
+    'recommend-lists': CachePolicy(CACHE_TIMEOUT, True, False, 0),
+    'toplist': CachePolicy(86400, True, False, 0),
+    'themes-songs': CachePolicy(86400, True, False, 0),
+    'radio-songs': CachePolicy(3600, False, False, 0),
+    'search': CachePolicy(3600, False, False, 60),
+    # lyrics are saved to LRC_DIR, only remember lyrics not found.
+    'lrc': CachePolicy(0, False, False, 3600),
+    # song links expire soon on server side, never keep them on disk.
+    'song-link': CachePolicy(600, False, False, 0),
+}
+
+# Parsed responses, url -> result of fetch(). This is the first tier,
+# cache_store is the second one.
+mem_cache = Cache.MemoryCache()
+# thumbnails, and big images of artists
+image_store = Cache.ImageStore(Config.IMG_DIR)
+large_image_store = Cache.ImageStore(Config.IMG_LARGE_DIR)
+# Songs and MVs cached locally, rid -> paths. Roots of songs and MVs
+# are set in apply_conf().
+library = Cache.LibraryIndex(Config.LIBRARY_JSON, exts=SONG_EXTS + MV_EXTS)
+# Disk usage of other cached files.
+lrc_quota = Cache.DiskQuota(Config.LRC_DIR, exts=('.lrc', ))
+# Song folder may be music folder of user, only songs in library are
+# managed by quotas.
+song_quota = Cache.DiskQuota(exts=SONG_EXTS, on_remove=library.discard,
+                             owns=library.contains)
+mv_quota = Cache.DiskQuota(exts=MV_EXTS, on_remove=library.discard,
+                           owns=library.contains)
+# Decoded images, (filepath, size) -> GdkPixbuf.Pixbuf
+pixbuf_cache = Cache.MemoryCache(PIXBUF_CACHE_SIZE)
+
+# LevelDB is used if available, else SQLite. cache_store is None only if
+# neither of them works.
+cache_store = Cache.open_store(Config.CACHE_DB, Config.CACHE_SQLITE,
+                               timeout=CACHE_TIMEOUT + CACHE_MAX_STALE)
+# urls being refreshed in background
+revalidating = set()
+revalidating_lock = threading.Lock()
+
+
+class Network:
+    '''Whether network can be used, requests fail at once if it can not.
+
+    Network is offline if user turns on offline mode, or NetworkMonitor
+    reports that there is no network, or OFFLINE_HOSTS different hosts
+    are down, like behind a broken proxy. A host is down after
+    OFFLINE_FAILURES connections to it failed in a row, requests to it
+    fail at once, but other hosts are not affected.
+    One request is let through every OFFLINE_RETRY seconds to check a
+    host which is down, or the network if several hosts are down.
+    In offline mode, responses in cache.db are served even if expired,
+    and only cached songs are played.
+    '''
+
+    def __init__(self):
+        self.forced = False
+        self.available = True
+        # host -> [failures in a row, time to check it again]
+        self.hosts = {}
+        self.retry_time = 0
+        # called in main thread with offline status when it changes
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def is_offline(self):
+        with self.lock:
+            return self.check_offline()
+
+    def check_offline(self):
+        '''Called with self.lock held.'''
+        return self.forced or not self.available or self.is_broken()
+
+    def is_broken(self):
+        '''Called with self.lock held.'''
+        down = [host for host, (failures, retry_time) in self.hosts.items()
+                if failures >= OFFLINE_FAILURES]
+        return len(down) >= OFFLINE_HOSTS
+
+    def allow_request(self, host):
+        '''Returns False if a request to host shall fail at once.'''
+        with self.lock:
+            if self.forced or not self.available:
+                return False
+            now = time.time()
+            if self.is_broken():
+                if now < self.retry_time:
+                    return False
+                self.retry_time = now + OFFLINE_RETRY
+                return True
+            state = self.hosts.get(host)
+            if not state or state[0] < OFFLINE_FAILURES:
+                return True
+            if now < state[1]:
+                return False
+            state[1] = now + OFFLINE_RETRY
+            return True
+
+    def set_forced(self, forced):
+        '''Offline mode turned on or off by user.'''
+        with self.lock:
+            if forced == self.forced:
+                return
+            self.forced = forced
+            self.hosts.clear()
+
+    def set_available(self, available):
+        '''Network monitor reports a change.'''
+        with self.lock:
+            old_offline = self.check_offline()
+            self.available = available
+            self.hosts.clear()
+            offline = self.check_offline()
+        # connections kept alive are broken now
+        http_pool.clear()
+        self.notify(old_offline, offline)
+
+    def failed(self, host):
+        '''Failed to connect to host.'''
+        with self.lock:
+            old_offline = self.check_offline()
+            state = self.hosts.setdefault(host, [0, 0])
+            state[0] += 1
+            if state[0] >= OFFLINE_FAILURES:
+                state[1] = time.time() + OFFLINE_RETRY
+                if not old_offline and self.is_broken():
+                    self.retry_time = state[1]
+            offline = self.check_offline()
+        self.notify(old_offline, offline)
+
+    def succeeded(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                return
+            old_offline = self.check_offline()
+            del self.hosts[host]
+            offline = self.check_offline()
+        self.notify(old_offline, offline)
+
+    def notify(self, old_offline, offline):
+        if offline == old_offline:
+            return
+        logger.info('Net.Network: offline is %s' % offline)
+        for listener in self.listeners:
+            dispatcher.call(listener, offline)
+
+network = Network()
+
+def start_network_monitor():
+    '''Follow network changes reported by system, run in main thread.'''
+    def on_network_changed(monitor, available):
+        network.set_available(available)
 
-# Using weak reference to cache song list in TopList and Radio.
-class Dict(dict):
-    pass
-req_cache = Dict()
-
-try:
-    # Debian: http://code.google.com/p/py-leveldb/
-    from leveldb import LevelDB
-    ldb_imported = True
-except ImportError:
-    logger.debug(traceback.format_exc())
-    ldb_imported = False
-
-ldb = None
-if ldb_imported:
     try:
-        ldb = LevelDB(Config.CACHE_DB, create_if_missing=True)
-        ldb_get = ldb.Get
-        ldb_put = ldb.Put
+        monitor = Gio.NetworkMonitor.get_default()
     except Exception:
-        logger.debug(traceback.format_exc())
-        ldb_imported = False
+        logger.warn(traceback.format_exc())
+        return
+    network.set_available(monitor.get_network_available())
+    monitor.connect('network-changed', on_network_changed)
+
+
+class PooledResponse:
+    '''HTTP response whose connection goes back to HTTPPool once drained.
+
+    Network errors raised while reading are converted to URLError.
+    '''
+
+    def __init__(self, pool, key, conn, resp):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            chunk = self.resp.read(amt)
+        except (OSError, http.client.HTTPException) as e:
+            self.abort()
+            raise URLError(e)
+        if self.resp.isclosed():
+            self.release()
+        return chunk
+
+    def release(self):
+        '''Put connection back to pool, or close it if it is not reusable.'''
+        if not self.conn:
+            return
+        conn, self.conn = self.conn, None
+        if self.resp.isclosed() and not self.resp.will_close:
+            self.pool.put_conn(self.key, conn)
+        else:
+            conn.close()
+
+    def abort(self):
+        '''Close response and its connection, connection is not reused.'''
+        self.resp.close()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def close(self):
+        # Response is not drained, its connection can not be reused.
+        if not self.resp.isclosed():
+            self.abort()
+        else:
+            self.release()
+
+
+class HTTPPool:
+    '''Keep-alive HTTP connections, grouped by (scheme, host, port, proxy).
+
+    Most requests are sent to a few hosts (search.kuwo.cn, image CDNs),
+    so reusing connections saves a TCP handshake for each of them.
+    At most `maxsize` idle connections are kept for each host.
+
+    Proxies are read from environment, like http_proxy and no_proxy, just
+    as urllib does. Plain HTTP requests through a proxy share connections
+    to the proxy, HTTPS requests are tunneled with CONNECT.
+    '''
+
+    def __init__(self, maxsize=POOL_SIZE, timeout=TIMEOUT):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.headers = {'User-Agent': 'Python-urllib/' + request.__version__}
+        self.proxies = request.getproxies()
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get_proxy(self, scheme, host):
+        '''Returns proxy url used for host, or None.'''
+        proxy = self.proxies.get(scheme)
+        if not proxy or request.proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return proxy
+
+    def set_maxsize(self, maxsize):
+        self.maxsize = max(maxsize, 0)
+        dropped = []
+        with self.lock:
+            for conns in self.idle.values():
+                while len(conns) > self.maxsize:
+                    dropped.append(conns.pop(0))
+        for conn in dropped:
+            conn.close()
+
+    def get_conn(self, key):
+        '''Returns (conn, reused).'''
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return (conns.pop(), True)
+        scheme, host, port, proxy = key
+        if not proxy:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(host, port,
+                                                   timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(host, port,
+                                                  timeout=self.timeout)
+            return (conn, False)
+        proxy_parts = parse.urlsplit(proxy)
+        proxy_port = proxy_parts.port or http.client.HTTP_PORT
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy_parts.hostname,
+                                               proxy_port,
+                                               timeout=self.timeout)
+            conn.set_tunnel(host, port, self.get_proxy_headers(proxy))
+        else:
+            conn = http.client.HTTPConnection(proxy_parts.hostname,
+                                              proxy_port,
+                                              timeout=self.timeout)
+        return (conn, False)
+
+    def get_proxy_headers(self, proxy):
+        proxy_parts = parse.urlsplit(proxy)
+        if not proxy_parts.username:
+            return {}
+        user_pass = '{0}:{1}'.format(parse.unquote(proxy_parts.username),
+                                     parse.unquote(proxy_parts.password or ''))
+        auth = base64.b64encode(user_pass.encode()).decode()
+        return {'Proxy-Authorization': 'Basic ' + auth}
+
+    def put_conn(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def request(self, url, headers=None, redirects=REDIRECTS):
+        '''Send a GET request, returns a PooledResponse object.
+
+        Raises URLError or HTTPError, just like urllib.request.urlopen().
+        URLError is raised at once if network is offline, or if the host
+        is down.
+        '''
+        for i in range(redirects + 1):
+            resp = self._request(url, headers)
+            if resp.status in (301, 302, 303, 307, 308):
+                location = resp.getheader('Location')
+                resp.read()
+                if not location:
+                    raise HTTPError(url, resp.status, resp.reason,
+                                    resp.headers, None)
+                url = parse.urljoin(url, location)
+                continue
+            if resp.status >= 400:
+                resp.close()
+                raise HTTPError(url, resp.status, resp.reason, resp.headers,
+                                None)
+            return resp
+        raise URLError('Too many redirects: %s' % url)
+
+    def _request(self, url, headers):
+        parts = parse.urlsplit(url)
+        if not network.allow_request(parts.hostname):
+            raise URLError('Network is offline, or host is down: %s' % url)
+        scheme = parts.scheme or 'http'
+        if scheme == 'https':
+            port = parts.port or http.client.HTTPS_PORT
+        else:
+            port = parts.port or http.client.HTTP_PORT
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        _headers = dict(self.headers)
+        if headers:
+            _headers.update(headers)
+        proxy = self.get_proxy(scheme, parts.hostname)
+        if proxy and scheme == 'http':
+            # all hosts share connections to proxy, with absolute urls
+            key = (scheme, None, None, proxy)
+            path = parse.urlunsplit((scheme, parts.netloc, path, '', ''))
+            _headers.update(self.get_proxy_headers(proxy))
+        else:
+            key = (scheme, parts.hostname, port, proxy)
+
+        while True:
+            conn, reused = self.get_conn(key)
+            try:
+                conn.request('GET', path, headers=_headers)
+                resp = conn.getresponse()
+                network.succeeded(parts.hostname)
+                return PooledResponse(self, key, conn, resp)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                # Server has closed this idle connection, try another one.
+                if reused:
+                    continue
+                network.failed(parts.hostname)
+                raise URLError(e)
+            except Exception:
+                conn.close()
+                raise
+
+http_pool = HTTPPool()
+
+def apply_conf(conf):
+    '''Update network settings, called at startup and after Preferences.'''
+    http_pool.set_maxsize(conf['http-pool-size'])
+    network.set_forced(conf['offline'])
+    bandwidth.set_limit(conf['bandwidth-limit'] * 1024)
+    if cache_store:
+        cache_store.max_size = conf['cache-db-size']
+    image_store.quota.max_size = conf['images-quota'] * MB
+    large_image_store.quota.max_size = conf['large-images-quota'] * MB
+    lrc_quota.max_size = conf['lrc-quota'] * MB
+    song_quota.max_size = conf['songs-quota'] * MB
+    mv_quota.max_size = conf['mvs-quota'] * MB
+    song_quota.set_root(conf['song-dir'])
+    mv_quota.set_root(conf['mv-dir'])
+    if library.set_roots((conf['song-dir'], conf['mv-dir'])):
+        async_call(load_library, priority=Priority.PREFETCH)
+
+def load_library():
+    '''Scan folders of songs and MVs once, for library and disk quotas.'''
+    scanned = library.load_index()
+    for quota in (song_quota, mv_quota):
+        if quota.root in scanned:
+            quota.load_index([entry for entry in scanned[quota.root] if
+                              library.contains(entry[0])])
+    logger.info('Net.load_library(): %s' % library.stats())
+
+class Priority:
+    '''Priority of background jobs, lower value runs first.'''
+    PLAYING = 0      # current song, like lyrics and song link
+    UI = 1           # data shown in visible widgets
+    THUMBNAIL = 2    # images in icon views
+    PREFETCH = 3     # background jobs, like refreshing cache
+
+
+class Executor:
+    '''A fixed number of worker threads sharing one priority queue.
+
+    Jobs with the same priority run in FIFO order. Worker threads are
+    started on demand, up to `workers`, and are never stopped.
+    '''
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.threads = []
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def submit(self, priority, func, *args):
+        self.queue.put((priority, next(self.counter), func, args))
+        with self.lock:
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def run(self):
+        while True:
+            priority, count, func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+executor = Executor()
+image_executor = Executor(IMAGE_WORKERS)
+# Scans of caches and refreshing may run for minutes, they have their own
+# threads so that workers of executor are kept for the playing song and
+# visible widgets.
+background_executor = Executor(BACKGROUND_WORKERS)
+
+
+class Dispatcher:
+    '''Run calls from worker threads in Gtk main thread, in batches.
+
+    Instead of one GLib.idle_add() for each call, calls are queued and
+    run by one idle handler, at most DISPATCH_BUDGET seconds each time,
+    so that a flood of model updates does not block redrawing. Batches
+    are bounded by time only, each model update still emits its own
+    signals.
 
-def async_call(func, *args, callback=None):
+        dispatcher.call(func, *args, key=None)
+
+    key    - pending call with the same key is replaced, so that only the
+             latest progress update runs, should be a tuple.
+    '''
+
+    def __init__(self):
+        # key -> (func, args), in FIFO order
+        self.calls = collections.OrderedDict()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.source = 0
+
+    def call(self, func, *args, key=None):
+        with self.lock:
+            if key is None:
+                key = next(self.counter)
+            else:
+                self.calls.pop(key, None)
+            self.calls[key] = (func, args)
+            if not self.source:
+                self.source = GLib.idle_add(self.run)
+
+    def run(self):
+        deadline = time.time() + DISPATCH_BUDGET
+        while True:
+            with self.lock:
+                if not self.calls:
+                    self.source = 0
+                    return False
+                if time.time() > deadline:
+                    return True
+                key, (func, args) = self.calls.popitem(False)
+            try:
+                func(*args)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+dispatcher = Dispatcher()
+
+
+class HostLimiter:
+    '''Limit num of concurrent requests to each host.
+
+        with limiter.get(url):
+            ...
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        host = parse.urlsplit(url or '').netloc.lower()
+        with self.lock:
+            semaphore = self.semaphores.get(host)
+            if not semaphore:
+                semaphore = threading.BoundedSemaphore(self.limit)
+                self.semaphores[host] = semaphore
+        return semaphore
+
+image_limiter = HostLimiter(IMAGE_HOST_CONNS)
+
+
+class Traffic:
+    '''Priority of song and MV downloads, lower value gets bandwidth first.'''
+    FOREGROUND = 0   # song or MV being played
+    PREFETCH = 1     # next song in playlist
+    CACHING = 2      # songs in Caching list
+
+
+class TokenBucket:
+    '''Limit data rate to `rate` bytes per second, 0 means no limit.
+
+    consume() blocks the calling thread until enough tokens are available.
+    Bursts up to one second of data are allowed.
+    '''
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = rate
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = 0
+                self.timestamp = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def consume(self, size):
+        with self.lock:
+            if not self.rate:
+                return
+            self.refill()
+            # Tokens may go negative, later callers wait for this debt too.
+            self.tokens -= size
+            if self.tokens >= 0:
+                return
+            delay = -self.tokens / self.rate
+        time.sleep(delay)
+
+
+class BandwidthScheduler:
+    '''Share bandwidth between song downloads of different Traffic.
+
+    While a download of higher priority is running, downloads of lower
+    priority are slowed down to BANDWIDTH_TRICKLE, so that they keep
+    their connections but leave the link to the former.
+    Downloads other than FOREGROUND are also limited by a user-set cap.
+    '''
+
+    def __init__(self):
+        self.levels = (Traffic.FOREGROUND, Traffic.PREFETCH, Traffic.CACHING)
+        self.active = [0 for level in self.levels]
+        self.buckets = [TokenBucket() for level in self.levels]
+        self.cap = TokenBucket()
+        self.lock = threading.Lock()
+
+    def set_limit(self, rate):
+        '''Set the cap of background downloads, 0 means no limit.'''
+        self.cap.set_rate(rate)
+
+    def enter(self, level):
+        with self.lock:
+            self.active[level] += 1
+            self.update()
+
+    def leave(self, level):
+        with self.lock:
+            self.active[level] -= 1
+            self.update()
+
+    def update(self):
+        for level in self.levels:
+            if any(self.active[:level]):
+                self.buckets[level].set_rate(BANDWIDTH_TRICKLE)
+            else:
+                self.buckets[level].set_rate(0)
+
+    def consume(self, level, size):
+        '''Called after `size` bytes are received by a download.'''
+        self.buckets[level].consume(size)
+        if level != Traffic.FOREGROUND:
+            self.cap.consume(size)
+
+bandwidth = BandwidthScheduler()
+
+def async_call(func, *args, callback=None, priority=Priority.UI):
     '''Call `func` in background thread, and then call `callback` in Gtk main thread.
 
     If error occurs in `func`, error will keep the traceback and passed to
     `callback` as second parameter. Always check `error` is not None.
+    `priority` is one of Priority values, jobs for the playing song and
+    visible widgets run before thumbnails. PREFETCH jobs run in
+    background_executor, they never take workers from other jobs.
     '''
     def do_call():
         result = None
@@ -84,22 +739,130 @@ def async_call(func, *args, callback=None):
         except Exception as e:
             error = e
         if callback:
-            GLib.idle_add(callback, result, error)
+            dispatcher.call(callback, result, error)
 
-    thread = threading.Thread(target=do_call)
-    thread.daemon = True
-    thread.start()
+    if priority >= Priority.PREFETCH:
+        background_executor.submit(priority, do_call)
+    else:
+        executor.submit(priority, do_call)
+
+def start_cache_maintenance():
+    '''Load indexes of cache.db and image stores in background, and
+    maintain cache.db periodically.
+
+    Expired and least recently used responses are removed, so cache.db
+    stays in the size limit.
+    '''
+    def maintain_cache():
+        mem_cache.prune()
+        if cache_store:
+            async_call(cache_store.maintain, priority=Priority.PREFETCH)
+        return True
+
+    if cache_store:
+        async_call(cache_store.load_index, priority=Priority.PREFETCH)
+    async_call(image_store.load_index, priority=Priority.PREFETCH)
+    async_call(large_image_store.load_index, priority=Priority.PREFETCH)
+    async_call(lrc_quota.load_index, priority=Priority.PREFETCH)
+    GLib.timeout_add_seconds(CACHE_MAINTAIN_INTERVAL, maintain_cache)
+
+def enforce_quotas(protected):
+    '''Remove least recently used files of each category over its quota.
+
+    protected - paths of songs and MVs in playlists or being played,
+                they are never removed.
+    Run it in background, at low priority.
+    '''
+    quotas = (
+        (image_store.quota, ()),
+        (large_image_store.quota, ()),
+        (lrc_quota, ()),
+        (song_quota, protected),
+        (mv_quota, protected),
+    )
+    for quota, protected_paths in quotas:
+        if quota.evict(protected_paths):
+            logger.info('Net.enforce_quotas(): %s' % quota.stats())
 
 def cleanup_temp_files(path):
-    def cleanup(ext):
-        if not os.path.exists(path) or not os.path.isdir(path):
-            return
-        os.chdir(path)
-        for filename in os.listdir():
-            if filename.endswith(ext):
-                os.remove(filename)
-    cleanup('.part')
-    cleanup('kwplayer_ar')
+    '''Remove temp files, but keep partial downloads which can be resumed.
+
+    Partial downloads are kept for PART_MAX_AGE seconds after their
+    sidecar was last written, abandoned ones are removed.
+    '''
+    if not os.path.exists(path) or not os.path.isdir(path):
+        return
+    filenames = set(os.listdir(path))
+    now = time.time()
+
+    def is_resumable(info_name):
+        if info_name not in filenames:
+            return False
+        try:
+            mtime = os.path.getmtime(os.path.join(path, info_name))
+        except OSError:
+            return False
+        return now - mtime < PART_MAX_AGE
+
+    for filename in filenames:
+        if filename.endswith('kwplayer_ar'):
+            pass
+        elif filename.endswith(PART_EXT):
+            if is_resumable(filename + PART_INFO_EXT):
+                continue
+        elif filename.endswith(PART_EXT + PART_INFO_EXT):
+            if (filename[:-len(PART_INFO_EXT)] in filenames and
+                    is_resumable(filename)):
+                continue
+        else:
+            continue
+        try:
+            os.remove(os.path.join(path, filename))
+        except OSError:
+            logger.warn(traceback.format_exc())
+
+def get_part_path(song_path):
+    '''Get path of partial file of a song or MV being downloaded.'''
+    return song_path + PART_EXT
+
+def load_part_info(part_path):
+    '''Load sidecar of a partial file, returns None if not found.
+
+    It contains url, expected length and validators (etag, last-modified)
+    of the file, used to resume downloading with Range requests.
+    '''
+    try:
+        with open(part_path + PART_INFO_EXT) as fh:
+            info = json.loads(fh.read())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(info, dict) or not info.get('length'):
+        return None
+    return info
+
+def dump_part_info(part_path, info):
+    with open(part_path + PART_INFO_EXT, 'w') as fh:
+        fh.write(json.dumps(info))
+
+def remove_part(part_path):
+    '''Remove partial file and its sidecar.'''
+    for filepath in (part_path, part_path + PART_INFO_EXT):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+def preallocate(fh, size):
+    '''Reserve disk space for a file, it is filled later.'''
+    try:
+        os.posix_fallocate(fh.fileno(), 0, size)
+    except (AttributeError, OSError):
+        fh.truncate(size)
+
+def parse_content_range(content_range):
+    '''Parse "bytes start-end/total", returns (start, total) or None.'''
+    match = re.match(r'bytes\s+(\d+)-\d+/(\d+)', content_range or '')
+    if not match:
+        return None
+    return (int(match.group(1)), int(match.group(2)))
 
 def hash_byte(_str):
     return hashlib.sha512(_str.encode()).digest()
@@ -107,34 +870,154 @@ def hash_byte(_str):
 def hash_str(_str):
     return hashlib.sha1(_str.encode()).hexdigest()
 
-def urlopen(_url, use_cache=True, retries=RETRIES):
-    # set host port from 81 to 80, to fix image problem
-    url = _url.replace(':81', '')
-    if use_cache and ldb_imported:
-        key = hash_byte(url)
+class SingleFlight:
+    '''Share one call between concurrent callers using the same key.
+
+    While a call for `key` is running, other callers wait for it and get
+    the same result, or the same exception.
+    '''
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = {'event': threading.Event(), 'result': None,
+                        'error': None}
+                self.calls[key] = call
+        if not is_leader:
+            call['event'].wait()
+            if call['error']:
+                raise call['error']
+            return call['result']
+
         try:
-            content = ldb_get(key)
-            if content and len(content) > 10:
-                try:
-                    timestamp = int(content[:10].decode())
-                    if (time.time() - timestamp) < CACHE_TIMEOUT:
-                        return content[10:]
-                except (ValueError, UnicodeDecodeError):
-                    logger.debug(traceback.format_exc())
-        except KeyError:
-            logger.debug(traceback.format_exc())
+            call['result'] = func(*args)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['event'].set()
+
+url_flight = SingleFlight()
+image_flight = SingleFlight()
+
+def canonical_url(url):
+    '''Normalize url, so that requests to the same resource can be shared'''
+    # set host port from 81 to 80, to fix image problem
+    url = url.strip().replace(':81', '')
+    parts = parse.urlsplit(url)
+    return parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                             parts.path, parts.query, ''))
+
+def urlopen(_url, policy=None, retries=RETRIES):
+    '''Get content of url, returns None if failed.
+
+    policy  - name of a CACHE_POLICIES item, default is None, response
+              is not cached. Only persistent policies are handled here,
+              use fetch() to cache parsed responses in memory.
+    retries - times to retry the request.
+    '''
+    return urlopen_expired(_url, policy, retries)[0]
+
+def urlopen_expired(_url, policy=None, retries=RETRIES):
+    '''Like urlopen(), returns (content, expired).
+
+    expired is True if content is an expired response in cache.db, served
+    while it is being refreshed, or while network is offline.
+    '''
+    url = canonical_url(_url)
+    policy = CACHE_POLICIES.get(policy)
+    if policy and policy.ttl and policy.persist and cache_store:
+        cached = cache_store.get(hash_byte(url), policy.ttl)
+        if cached:
+            content, expired = cached
+            if not expired:
+                return (content, False)
+            if network.is_offline():
+                return (content, True)
+            if policy.stale:
+                with revalidating_lock:
+                    queued = url in revalidating
+                    revalidating.add(url)
+                if not queued:
+                    async_call(revalidate, url, policy, retries,
+                               priority=Priority.PREFETCH)
+                return (content, True)
+    return (url_flight.do(url, _urlopen, url, policy, retries), False)
+
+def revalidate(url, policy, retries=RETRIES):
+    '''Refresh a stale response in cache.db.
+
+    Run in background, at low priority. Failures are ignored, stale
+    response is served until next refresh succeeds.
+    '''
+    try:
+        if url_flight.do(url, _urlopen, url, policy, retries):
+            # parsed from the stale response
+            mem_cache.delete(url)
+    finally:
+        with revalidating_lock:
+            revalidating.discard(url)
+
+def _urlopen(url, policy, retries):
     for i in range(retries):
         try:
-            req = request.urlopen(url, timeout=TIMEOUT)
+            req = http_pool.request(url)
             req_content = req.read()
-            if use_cache and ldb_imported:
-                ldb_put(key, str(int(time.time())).encode() + req_content)
+            if policy and policy.persist and cache_store:
+                cache_store.put(hash_byte(url), req_content)
             return req_content
         except URLError:
+            if network.is_offline():
+                logger.debug('Net.urlopen, offline: %s' % url)
+                break
             logger.warn(traceback.format_exc())
             logger.warn('Net.urlopen, url: %s' % url)
     return None
 
+def fetch(_url, policy, parse, retries=RETRIES):
+    '''Get url and parse its content, results are cached in memory.
+
+    policy - name of a CACHE_POLICIES item.
+    parse  - function to convert response content to result, returns
+             None if content is invalid. Exceptions are logged.
+    Returns result, or None if failed. Results are shared between
+    callers, do not modify them.
+    '''
+    url = canonical_url(_url)
+    cached, result = mem_cache.get(url)
+    if cached:
+        return result
+
+    policy_name, policy = policy, CACHE_POLICIES[policy]
+    req_content, expired = urlopen_expired(url, policy_name, retries)
+    if req_content:
+        try:
+            result = parse(req_content)
+        except Exception:
+            logger.error(traceback.format_exc())
+    if result is not None:
+        # Expired ones are parsed again next time, until refreshed.
+        if policy.ttl and not expired:
+            mem_cache.put(url, result, len(req_content), policy.ttl)
+    elif policy.negative and not network.is_offline():
+        mem_cache.put(url, None, 0, policy.negative)
+    return result
+
+def parse_json(content):
+    return json.loads(content.decode())
+
+def parse_json_single(content):
+    return Utils.json_loads_single(content.decode())
+
 def get_nodes(nid, page):
     # node list contains very few items
     url = ''.join([
@@ -146,43 +1029,125 @@ def get_nodes(nid, page):
         '&node=',
         str(nid),
     ])
-    req_content = urlopen(url)
-    if not req_content:
-        return (None, 0)
-    try:
-        nodes_wrap = json.loads(req_content.decode())
-    except ValueError:
-        logger.error(traceback.format_exc())
+    nodes_wrap = fetch(url, 'nodes', parse_json)
+    if not nodes_wrap:
         return (None, 0)
     nodes = nodes_wrap['child']
     pages = math.ceil(int(nodes_wrap['total']) / ICON_NUM)
     return (nodes, pages)
 
-def get_image(url, filepath=None):
+def get_image(url, store=None, size=0):
+    '''Get image of url, returns its file path, or None if failed.
+
+    store - an ImageStore, default is image_store, which keeps thumbnails.
+    size  - display size of thumbnail. If not 0, image is scaled down to
+            fit in size x size when downloaded, and only the thumbnail is
+            saved. Default is 0, saves the original image.
+    '''
     if not url or len(url) < 10:
         logger.error('Net.get_image: url is invalid, %s' % url)
         return None
-    if not filepath:
-        filename = os.path.split(url)[1]
-        filepath = os.path.join(Config.IMG_DIR, filename)
-    if os.path.exists(filepath):
+    url = url.strip()
+    if not store:
+        store = image_store
+    filepath = store.lookup(url, size)
+    if filepath:
         return filepath
+    # The same image may be shown in several views at the same time.
+    return image_flight.do((url, size), _get_image, url, store, size)
 
-    image = urlopen(url, use_cache=False)
+def _get_image(url, store, size):
+    filepath = store.lookup(url, size)
+    if filepath:
+        return filepath
+    # Original image may be saved by older versions.
+    orig_path = size and store.lookup(url)
+    if orig_path:
+        try:
+            with open(orig_path, 'rb') as fh:
+                image = fh.read()
+        except OSError:
+            logger.warn(traceback.format_exc())
+            image = None
+    else:
+        image = None
+    if not image:
+        image = urlopen(url)
     if not image:
         logger.debug('Net.get_image: failed to get image, %s' % image)
         return None
+    if size:
+        image = scale_image(image, size)
+        if not image:
+            return None
+    try:
+        return store.put(url, image, size)
+    except OSError:
+        logger.error(traceback.format_exc())
+        return None
+
+def scale_image(content, size):
+    '''Scale image down to fit in size x size, keeping its aspect ratio.
+
+    Returns encoded image, JPEG images are still saved as JPEG, others as
+    PNG. If image is small enough, content is returned as it is.
+    Returns None if content is not a valid image.
+    '''
+    def on_size_prepared(loader, width, height):
+        if width > size or height > size:
+            ratio = min(size / width, size / height)
+            loader.set_size(max(1, round(width * ratio)),
+                            max(1, round(height * ratio)))
+            scaled[0] = True
+
+    scaled = [False]
+    loader = GdkPixbuf.PixbufLoader()
+    loader.connect('size-prepared', on_size_prepared)
+    try:
+        loader.write(content)
+        loader.close()
+    except GLib.GError:
+        logger.error(traceback.format_exc())
+        return None
+    pix = loader.get_pixbuf()
+    if not pix:
+        return None
+    img_format = loader.get_format().get_name()
+    if not scaled[0] and img_format in ('jpeg', 'png'):
+        return content
+    try:
+        if img_format == 'jpeg':
+            status, buf = pix.save_to_bufferv('jpeg', ['quality'], ['90'])
+        else:
+            status, buf = pix.save_to_bufferv('png', [], [])
+    except GLib.GError:
+        logger.error(traceback.format_exc())
+        return None
+    if not status:
+        return None
+    return buf
+
+def get_pixbuf(filepath, size=IMG_SIZE):
+    '''Load image and scale it to fit in size x size.
 
-    with open(filepath, 'wb') as fh:
-        fh.write(image)
-    return filepath
+    Decoded pixbufs are shared in pixbuf_cache, call it in background
+    thread. Returns None if failed.
+    '''
+    key = (filepath, size)
+    cached, pix = pixbuf_cache.get(key)
+    if cached:
+        return pix
+    try:
+        pix = GdkPixbuf.Pixbuf.new_from_file_at_size(filepath, size, size)
+    except GLib.GError:
+        logger.error(traceback.format_exc())
+        return None
+    pixbuf_cache.put(key, pix, pix.get_rowstride() * pix.get_height())
+    return pix
 
 def get_album(albumid):
     url = '{0}stype=albuminfo&albumid={1}'.format(SEARCH, albumid)
-    req_content = urlopen(url)
-    if not req_content:
-        return None
-    songs_wrap = Utils.json_loads_single(req_content.decode())
+    songs_wrap = fetch(url, 'album', parse_json_single)
     if not songs_wrap:
         return None
     songs = songs_wrap['musiclist']
@@ -190,7 +1155,7 @@ def get_album(albumid):
 
 def update_liststore_images(liststore,  col, tree_iters, urls,
                             url_proxy=None, resize=IMG_SIZE):
-    '''Update a banch of thumbnails consequently.
+    '''Update a banch of thumbnails concurrently.
 
     liststore - the tree model, which has timestamp property
     col       - column index
@@ -198,33 +1163,44 @@ def update_liststore_images(liststore,  col, tree_iters, urls,
     urls      - a list of image urls
     url_proxy - a function to reconstruct image url, this function run in 
                 background thread. default is None, do nothing.
-    resize    - will resize pixbuf to specific size, default is 100x100
+    resize    - will resize pixbuf to specific size, default is 100x100.
+                Images are scaled to this size when downloaded.
+
+    Images are downloaded and decoded in image_executor, in the order of
+    tree_iters, so rows on top are shown first. At most IMAGE_HOST_CONNS images are
+    downloaded from the same host at the same time. Pending images are
+    dropped once liststore.timestamp changes.
     '''
-    def update_image(filepath, tree_iter):
-        try:
-            pix = GdkPixbuf.Pixbuf.new_from_file_at_size(filepath, resize,
-                                                         resize)
-            tree_path = liststore.get_path(tree_iter)
-            if tree_path is not None:
-                liststore[tree_path][col] = pix
-        except Exception:
-            logger.error(traceback.format_exc())
+    def update_image(pix, tree_iter):
+        if liststore.timestamp != timestamp:
+            return
+        tree_path = liststore.get_path(tree_iter)
+        if tree_path is not None:
+            liststore[tree_path][col] = pix
 
-    timestamp = liststore.timestamp
-    for tree_iter, url in zip(tree_iters, urls):
-        # First, check timestamp matches
+    def fetch_image(tree_iter, url):
+        # liststore has been reloaded
         if liststore.timestamp != timestamp:
-            break
+            return
         if url_proxy:
             url = url_proxy(url)
         try:
-            filepath = get_image(url)
+            with image_limiter.get(url):
+                if liststore.timestamp != timestamp:
+                    return
+                filepath = get_image(url, size=resize)
         except Exception:
             logger.error(traceback.format_exc())
-            continue
-        if filepath:
-            GLib.idle_add(update_image, filepath, tree_iter)
+            return
+        if not filepath:
+            return
+        pix = get_pixbuf(filepath, resize)
+        if pix:
+            dispatcher.call(update_image, pix, tree_iter)
 
+    timestamp = liststore.timestamp
+    for tree_iter, url in zip(tree_iters, urls):
+        image_executor.submit(Priority.THUMBNAIL, fetch_image, tree_iter, url)
 
 def update_album_covers(liststore, col, tree_iters, urls):
     def url_proxy(url):
@@ -252,15 +1228,8 @@ def get_toplist_songs(nid):
         '&id=',
         str(nid),
     ])
-    if url not in req_cache:
-        req_content = urlopen(url, use_cache=False)
-        if not req_content:
-            return None
-        req_cache[url] = req_content
-    try:
-        songs_wrap = json.loads(req_cache[url].decode())
-    except ValueError:
-        logger.error(traceback.format_exc())
+    songs_wrap = fetch(url, 'toplist', parse_json)
+    if not songs_wrap:
         return None
     return songs_wrap['musiclist']
 
@@ -276,10 +1245,7 @@ def get_artists(catid, page, prefix):
     ])
     if len(prefix) > 0:
         url = url + '&prefix=' + prefix
-    req_content = urlopen(url)
-    if not req_content:
-        return (None, 0)
-    artists_wrap = Utils.json_loads_single(req_content.decode())
+    artists_wrap = fetch(url, 'artists', parse_json_single)
     if not artists_wrap:
         return (None, 0)
     pages = int(artists_wrap['total'])
@@ -301,7 +1267,8 @@ def update_artist_logos(liststore, col, tree_iters, urls):
 def get_artist_info(artistid, artist=None):
     '''Get artist info, if cached, just return it.
 
-    Artist pic is also retrieved and saved to info['pic']
+    Artist pic is also retrieved and saved to info['pic'], and its
+    thumbnail is saved to info['pixbuf'].
     '''
     if artistid == 0:
         url = ''.join([
@@ -315,19 +1282,22 @@ def get_artist_info(artistid, artist=None):
             'stype=artistinfo&artistid=', 
             str(artistid),
         ])
-    req_content = urlopen(url)
-    if not req_content:
-        return None
-    info = Utils.json_loads_single(req_content.decode())
+    info = fetch(url, 'artist-info', parse_json_single)
     if not info:
         return None
+    # info is shared in mem_cache
+    info = dict(info)
     # set logo size to 100x100
     pic_path = info['pic']
     url = get_artist_pic_url(pic_path)
     if url:
-        info['pic'] = get_image(url)
+        info['pic'] = get_image(url, size=IMG_SIZE)
     else:
         info['pic'] = None
+    if info['pic']:
+        info['pixbuf'] = get_pixbuf(info['pic'])
+    else:
+        info['pixbuf'] = None
     return info
 
 def get_artist_songs(artist, page):
@@ -340,10 +1310,7 @@ def get_artist_songs(artist, page):
         '&primitive=0&rformat=json&encoding=UTF8&artist=',
         artist,
     ])
-    req_content = urlopen(url)
-    if not req_content:
-        return (None, 0)
-    songs_wrap = Utils.json_loads_single(req_content.decode())
+    songs_wrap = fetch(url, 'artist-songs', parse_json_single)
     if not songs_wrap:
         return (None, 0)
     songs = songs_wrap['abslist']
@@ -360,10 +1327,7 @@ def get_artist_songs_by_id(artistid, page):
         '&pn=',
         str(page),
     ])
-    req_content = urlopen(url)
-    if not req_content:
-        return (None, 0)
-    songs_wrap = Utils.json_loads_single(req_content.decode())
+    songs_wrap = fetch(url, 'artist-songs', parse_json_single)
     if not songs_wrap:
         return (None, 0)
     songs = songs_wrap['musiclist']
@@ -380,10 +1344,7 @@ def get_artist_albums(artistid, page):
         '&pn=',
         str(page),
     ])
-    req_content = urlopen(url)
-    if not req_content:
-        return (None, 0)
-    albums_wrap = Utils.json_loads_single(req_content.decode())
+    albums_wrap = fetch(url, 'artist-albums', parse_json_single)
     if not albums_wrap:
         return (None, 0)
     albums = albums_wrap['albumlist']
@@ -400,10 +1361,7 @@ def get_artist_mv(artistid, page):
         '&pn=',
         str(page),
     ])
-    req_content = urlopen(url)
-    if not req_content:
-        return (None, 0)
-    mvs_wrap = Utils.json_loads_single(req_content.decode())
+    mvs_wrap = fetch(url, 'mv-songs', parse_json_single)
     if not mvs_wrap:
         return (None, 0)
     mvs = mvs_wrap['mvlist']
@@ -421,10 +1379,7 @@ def get_artist_similar(artistid, page):
         '&artistid=',
         str(artistid),
     ])
-    req_content = urlopen(url)
-    if not req_content:
-        return (None, 0)
-    artists_wrap = Utils.json_loads_single(req_content.decode())
+    artists_wrap = fetch(url, 'artists', parse_json_single)
     if not artists_wrap:
         return (None, 0)
     artists = artists_wrap['artistlist']
@@ -447,19 +1402,12 @@ def get_lrc(song):
     def _parse_lrc():
         url = ('http://newlyric.kuwo.cn/newlyric.lrc?' + 
                 Utils.encode_lrc_url(rid))
-        req_content = urlopen(url, use_cache=False, retries=8)
-        if not req_content:
-            return None
-        try:
-            lrc = Utils.decode_lrc_content(req_content)
-            return lrc
-        except Exception:
-            logger.error(traceback.format_exc())
-            return None
+        return fetch(url, 'lrc', Utils.decode_lrc_content, retries=8)
 
     rid = str(song['rid'])
     (lrc_path, lrc_cached) = get_lrc_path(song)
     if lrc_cached:
+        lrc_quota.touch(lrc_path)
         with open(lrc_path) as fh:
             return fh.read()
 
@@ -467,6 +1415,7 @@ def get_lrc(song):
     if lrc:
         with open(lrc_path, 'w') as fh:
             fh.write(lrc)
+        lrc_quota.add(lrc_path)
     return lrc
 
 def get_recommend_lists(artist):
@@ -476,18 +1425,14 @@ def get_recommend_lists(artist):
         '&name=',
         Utils.encode_uri(artist),
     ])
-    req_content = urlopen(url)
+    req_content = urlopen(url, policy='recommend-lists')
     if not req_content:
         return None
     return req_content.decode()
 
 def get_recommend_image(_url):
     '''Get big cover image about this artist, normally 1024x768'''
-    url = _url.strip()
-    ext = os.path.splitext(url)[1]
-    filename = hash_str(url) + ext
-    filepath = os.path.join(Config.IMG_LARGE_DIR, filename)
-    return get_image(url, filepath)
+    return get_image(_url, large_image_store)
 
 def search_songs(keyword, page):
     url = ''.join([
@@ -500,12 +1445,7 @@ def search_songs(keyword, page):
         '&pn=',
         str(page),
     ])
-    if url not in req_cache:
-        req_content = urlopen(url, use_cache=False)
-        if not req_content:
-            return (None, 0, 0)
-        req_cache[url] = req_content
-    songs_wrap = Utils.json_loads_single(req_cache[url].decode())
+    songs_wrap = fetch(url, 'search', parse_json_single)
     if not songs_wrap:
         return (None, 0, 0)
     hit = int(songs_wrap['TOTAL'])
@@ -524,12 +1464,7 @@ def search_artists(keyword, page):
         '&itemset=newkm&rformat=json&encoding=utf8&all=',
         parse.quote(keyword),
     ])
-    if url not in req_cache:
-        req_content = urlopen(url, use_cache=False)
-        if not req_content:
-            return (None, 0, 0)
-        req_cache[url] = req_content
-    artists_wrap = Utils.json_loads_single(req_cache[url].decode())
+    artists_wrap = fetch(url, 'search', parse_json_single)
     if not artists_wrap:
         return (None, 0, 0)
     hit = int(artists_wrap['TOTAL'])
@@ -548,12 +1483,7 @@ def search_albums(keyword, page):
         '&itemset=newkm&rformat=json&encoding=utf8&all=',
         parse.quote(keyword),
     ])
-    if url not in req_cache:
-        req_content = urlopen(url, use_cache=False)
-        if not req_content:
-            return (None, 0, 0)
-        req_cache[url] = req_content
-    albums_wrap = Utils.json_loads_single(req_cache[url].decode())
+    albums_wrap = fetch(url, 'search', parse_json_single)
     if not albums_wrap:
         return (None, 0, 0)
     hit = int(albums_wrap['total'])
@@ -570,13 +1500,8 @@ def get_index_nodes(nid):
         '&node=',
         str(nid),
     ])
-    req_content = urlopen(url)
-    if not req_content:
-        return None
-    try:
-        nodes_wrap = json.loads(req_content.decode())
-    except ValueError:
-        logger.error(traceback.format_exc())
+    nodes_wrap = fetch(url, 'nodes', parse_json)
+    if not nodes_wrap:
         return None
     return nodes_wrap
 
@@ -637,15 +1562,8 @@ def get_themes_songs(nid, page):
         '&pn=',
         str(page),
     ])
-    if url not in req_cache:
-        req_content = urlopen(url, use_cache=False)
-        if not req_content:
-            return (None, 0)
-        req_cache[url] = req_content
-    try:
-        songs_wrap = json.loads(req_cache[url].decode())
-    except ValueError:
-        logger.error(traceback.format_exc())
+    songs_wrap = fetch(url, 'themes-songs', parse_json)
+    if not songs_wrap:
         return (None, 0)
     pages = math.ceil(int(songs_wrap['total']) / SONG_NUM)
     return (songs_wrap['musiclist'], pages)
@@ -660,13 +1578,8 @@ def get_mv_songs(pid, page):
         '&encode=utf-8&keyset=mvpl&pid=',
         str(pid),
     ])
-    req_content = urlopen(url)
-    if not req_content:
-        return (None, 0)
-    try:
-        songs_wrap = json.loads(req_content.decode())
-    except ValueError:
-        logger.error(traceback.format_exc())
+    songs_wrap = fetch(url, 'mv-songs', parse_json)
+    if not songs_wrap:
         return (None, 0)
     songs = songs_wrap['musiclist']
     pages = math.ceil(int(songs_wrap['total']) / ICON_NUM)
@@ -684,11 +1597,88 @@ def get_radio_songs(nid, offset):
         '&offset=',
         str(offset),
     ])
-    req_content = urlopen(url)
-    if not req_content:
+    songs = fetch(url, 'radio-songs',
+                  lambda content: Utils.parse_radio_songs(content.decode('gbk')))
+    if not songs:
         return None
-    songs = Utils.parse_radio_songs(req_content.decode('gbk'))
-    return songs
+    # Radio appends more songs to this list
+    return list(songs)
+
+def get_song_format(song, conf, use_mv=False):
+    '''Choose bitrate/quality of this song (or MV) from conf.
+
+    Returns (br, ext), like ('320kmp3', 'mp3') or ('MP4L', 'mp4').
+    '''
+    audio_brs = ['128kmp3', '192kmp3', '320kmp3', '2000kflac']
+    audio_formats = ['MP3128', 'MP3192', 'MP3H', 'AL']
+    video_formats = ['MP4L', 'MP4']
+    if use_mv:
+        if video_formats[1] in song.get('formats', '') and conf['video'] == 1:
+            return (video_formats[1], 'mp4')
+        return (video_formats[0], 'mp4')
+
+    song_formats = song.get('formats', '')
+    if conf['audio'] == 3 and audio_formats[3] in song_formats:
+        return (audio_brs[3], 'flac')
+    elif conf['audio'] >= 2 and audio_formats[2] in song_formats:
+        return (audio_brs[2], 'mp3')
+    elif conf['audio'] >= 1 and audio_formats[1] in song_formats:
+        return (audio_brs[1], 'mp3')
+    return (audio_brs[0], 'mp3')
+
+def _parse_song_link(req_content):
+    match = re.search('url=(\S+)\s', req_content.decode())
+    if not match:
+        return None
+    song_link = match.group(1)
+    if len(song_link) < 20:
+        return None
+    song_list = song_link.split('/')
+    return '/'.join(song_list[:3] + song_list[5:])
+
+def get_song_name(song):
+    '''File name of song without extension, like artist-name.'''
+    return (song['artist'] + '-' + song['name']).replace('/', '+')
+
+def get_cached_song(song, conf, use_mv=False, ext=None):
+    '''Get path of song (or MV) cached locally, never touches network.
+
+    ext - extension of the file, default is chosen from conf.
+    Returns None if it is not cached.
+    '''
+    br, conf_ext = get_song_format(song, conf, use_mv)
+    ext = ext or conf_ext
+    rid = str(song['rid'])
+    song_path = library.find(rid, br, ext)
+    if not song_path:
+        # saved by older versions, named by title only
+        if use_mv:
+            song_dir = conf['mv-dir']
+        else:
+            song_dir = conf['song-dir']
+        song_path = os.path.join(song_dir, get_song_name(song) + '.' + ext)
+        if not library.adopt(rid, br, song_path):
+            return None
+        # it can be managed by quotas now
+        if use_mv:
+            mv_quota.add(song_path)
+        else:
+            song_quota.add(song_path)
+    if use_mv:
+        mv_quota.touch(song_path)
+    else:
+        song_quota.touch(song_path)
+    return song_path
+
+def remove_song_file(song_path):
+    '''Remove a cached song or MV, and forget it in library and quotas.'''
+    try:
+        os.remove(song_path)
+    except FileNotFoundError:
+        pass
+    library.discard(song_path)
+    song_quota.discard(song_path)
+    mv_quota.discard(song_path)
 
 def get_song_link(song, conf, use_mv=False):
     '''song is song_info dict.
@@ -702,15 +1692,8 @@ def get_song_link(song, conf, use_mv=False):
               music source link, returns ''
      @song_path: target abs-path this song will be cached.
     '''
-    audio_brs = ['128kmp3', '192kmp3', '320kmp3', '2000kflac']
-    audio_formats = ['MP3128', 'MP3192', 'MP3H', 'AL']
-    video_formats = ['MP4L', 'MP4']
+    br, ext = get_song_format(song, conf, use_mv)
     if use_mv:
-        if video_formats[1] in song.get('formats', '') and conf['video'] == 1:
-            br = video_formats[1]
-        else:
-            br = video_formats[0]
-        ext = 'mp4'
         url = ''.join([
             'user=359307055300426&prod=kwplayer_ar_6.4.8.0',
             '&corp=kuwo&source=kwplayer_ar_6.4.8.0_kw.apk&p2p=1',
@@ -719,17 +1702,6 @@ def get_song_link(song, conf, use_mv=False):
             '&network=WIFI&mode=audition&format=mp4&br=&sig='
         ])
     else:
-        ext = 'mp3'
-        song_formats = song.get('formats', '')
-        if conf['audio'] == 3 and audio_formats[3] in song_formats:
-            br = audio_brs[3]
-            ext = 'flac'
-        elif conf['audio'] >= 2 and audio_formats[2] in song_formats:
-            br = audio_brs[2]
-        elif conf['audio'] >= 1 and audio_formats[1] in song_formats:
-            br = audio_brs[1]
-        else:
-            br = audio_brs[0]
         url = ''.join([
             'user=359307055300426&prod=kwplayer_ar_6.4.8.0&corp=kuwo',
             '&source=kwplayer_ar_6.4.8.0_kw.apk&p2p=1&type=convert_url2',
@@ -739,33 +1711,808 @@ def get_song_link(song, conf, use_mv=False):
         ])
 
     url = 'http://mobi.kuwo.cn/mobi.s?f=kuwo&q=' + DES.base64_encrypt(url)
-    song_name = (''.join(
-        [song['artist'], '-', song['name'], '.', ext, ])).replace('/', '+')
+    song_path = get_cached_song(song, conf, use_mv)
+    if song_path:
+        return (True, '', song_path)
+    song_link = fetch(url, 'song-link', _parse_song_link)
+    if song_link:
+        # server may send another format
+        link_ext = os.path.splitext(parse.urlparse(song_link).path)[1][1:]
+        if link_ext and link_ext != ext:
+            ext = link_ext
+            song_path = get_cached_song(song, conf, use_mv, ext)
+            if song_path:
+                return (True, '', song_path)
     if use_mv:
-        song_path = os.path.join(conf['mv-dir'], song_name)
+        song_dir = conf['mv-dir']
     else:
-        song_path = os.path.join(conf['song-dir'], song_name)
-    if os.path.exists(song_path):
-        return (True, '', song_path)
-    req_content = urlopen(url)
-    if not req_content:
-        return (False, '', song_path)
-    match = re.search('url=(\S+)\s', req_content.decode())
-    if not match:
-        return (False, '', song_path)
-    song_link = match.group(1)
-    if len(song_link) < 20:
+        song_dir = conf['song-dir']
+    song_path = library.new_path(str(song['rid']), song_dir,
+                                 get_song_name(song), ext)
+    if not song_link:
         return (False, '', song_path)
-    song_list = song_link.split('/')
-    song_link = '/'.join(song_list[:3] + song_list[5:])
-    # update song path
-    song_path = ''.join([os.path.splitext(song_path)[0],
-            os.path.splitext(parse.urlparse(song_link).path)[1]])
-    if os.path.exists(song_path):
-        return (True, '', song_path)
     return (False, song_link, song_path)
 
 
+# AsyncSong objects downloading the same song share one SongDownload.
+# key is (rid, br), like ('928003', '320kmp3').
+song_flights = {}
+song_flights_lock = threading.RLock()
+
+
+class Segments:
+    '''Byte ranges of a file downloaded by several connections.
+
+    Each segment is a list of [next byte to fetch, last byte].
+    Urgent segments, made when player seeks, are fetched first.
+    '''
+
+    def __init__(self, segments, length):
+        self.urgent = []
+        self.pending = sorted(list(segment) for segment in segments)
+        self.active = []
+        self.length = length
+        self.error = None
+        self.head_used = False
+        self.changed = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def stopped(self):
+        return self.error is not None
+
+    def stop(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.changed.set()
+
+    def wait(self, timeout):
+        self.changed.wait(timeout)
+        self.changed.clear()
+
+    def left(self):
+        '''All segments not received, called with self.lock held.'''
+        return self.urgent + self.pending + self.active
+
+    def take(self):
+        '''Get the first pending segment, returns None if no one left.'''
+        with self.lock:
+            if self.urgent:
+                segment = self.urgent.pop(0)
+            elif self.pending:
+                segment = self.pending.pop(0)
+            else:
+                return None
+            self.active.append(segment)
+            return segment
+
+    def split(self, offset):
+        '''Fetch data from offset as soon as possible.
+
+        Segment containing offset is split at offset, and its tail
+        becomes an urgent segment. Nothing is done if offset will be
+        received soon.
+        Returns True if a new urgent segment is waiting for a connection.
+        '''
+        with self.lock:
+            for segment in self.left():
+                if not segment[0] <= offset <= segment[1]:
+                    continue
+                if offset - segment[0] >= SEEK_GAP:
+                    self.urgent.insert(0, [offset, segment[1]])
+                    # Connection of an active segment stops at offset.
+                    segment[1] = offset - 1
+                    return True
+                if segment in self.pending:
+                    self.pending.remove(segment)
+                    self.urgent.insert(0, segment)
+                    return True
+                return False
+        return False
+
+    def advance(self, segment, size):
+        with self.lock:
+            segment[0] += size
+        self.changed.set()
+
+    def done(self, segment):
+        with self.lock:
+            self.active.remove(segment)
+        self.changed.set()
+
+    def release(self, segment):
+        '''Put an unfinished segment back.'''
+        with self.lock:
+            self.active.remove(segment)
+            if segment[0] <= segment[1]:
+                self.pending.append(segment)
+                self.pending.sort()
+        self.changed.set()
+
+    def remaining(self):
+        with self.lock:
+            return sorted(list(segment) for segment in self.left())
+
+    def received(self):
+        with self.lock:
+            left = sum(end - start + 1 for start, end in self.left())
+        return self.length - left
+
+    def available_end(self, offset):
+        '''End (exclusive) of data received from offset.
+
+        Returns offset itself if byte at offset is not received yet.
+        '''
+        end = self.length
+        with self.lock:
+            for start, last in self.left():
+                if start <= offset <= last:
+                    return offset
+                if start > offset:
+                    end = min(end, start)
+        return end
+
+    def playable(self):
+        '''Size of data received from the beginning of file.'''
+        with self.lock:
+            starts = [segment[0] for segment in self.left()]
+        if starts:
+            return min(starts)
+        return self.length
+
+
+class PartialFile:
+    '''A song (or MV) file being downloaded, it can be read at the same time.
+
+    Readers, like the stream server of PlayerBin, call wait() to block
+    until data they want arrives.
+    '''
+
+    def __init__(self, path, length, segments=None):
+        self.part_path = path
+        # path is changed to the final one once downloaded
+        self.path = path
+        self.length = length
+        # Segments, if file is downloaded with several connections,
+        # else size of data received from the beginning of file.
+        self.segments = segments
+        self.received = 0
+        self.complete = False
+        self.closed = False
+        # called with offset, when a reader wants data not received
+        self.seek_handler = None
+        self.cond = threading.Condition()
+
+    def available_end(self, offset):
+        if self.complete:
+            return self.length
+        if self.segments:
+            return self.segments.available_end(offset)
+        return max(offset, self.received)
+
+    def request(self, offset):
+        '''A reader is going to read from offset, like after seeking.
+
+        Lets downloader fetch data at offset first if it is far away.
+        '''
+        if (self.seek_handler and not self.closed and
+                self.available_end(offset) <= offset):
+            self.seek_handler(offset)
+
+    def reset(self, length, received=0, segments=None):
+        '''Download restarts, maybe in another mode.'''
+        with self.cond:
+            self.length = length
+            self.received = received
+            self.segments = segments
+            self.cond.notify_all()
+
+    def update(self, received=None):
+        '''Called when new data is written and flushed.'''
+        with self.cond:
+            if received is not None:
+                self.received = received
+            self.cond.notify_all()
+
+    def finish(self, path):
+        '''Download completed and file is renamed to path.'''
+        with self.cond:
+            self.path = path
+            self.complete = True
+            self.closed = True
+            self.cond.notify_all()
+
+    def close(self):
+        '''Download stopped, no more data will come.'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def wait(self, offset, timeout=None):
+        '''Wait for data at offset, returns end of data available.
+
+        Returns offset itself if timeout, or if download is closed.
+        '''
+        with self.cond:
+            end = self.available_end(offset)
+            if end <= offset and not self.closed:
+                self.cond.wait(timeout)
+                end = self.available_end(offset)
+            return end
+
+# tmp song path -> PartialFile, files being downloaded
+partial_files = {}
+partial_files_lock = threading.Lock()
+
+def get_partial_file(path):
+    '''Get PartialFile of path, returns None if it is not downloading.'''
+    with partial_files_lock:
+        return partial_files.get(path)
+
+
+class Throughput:
+    '''Rolling download rate over the last THROUGHPUT_WINDOW seconds.'''
+
+    def __init__(self):
+        # (timestamp, total received bytes)
+        self.samples = collections.deque()
+
+    def add(self, received_size):
+        now = time.time()
+        self.samples.append((now, received_size))
+        while (len(self.samples) > 2 and
+                self.samples[1][0] < now - THROUGHPUT_WINDOW):
+            self.samples.popleft()
+
+    def rate(self):
+        '''Returns bytes per second, or None if not measured yet.'''
+        if len(self.samples) < 2:
+            return None
+        start, start_size = self.samples[0]
+        end, end_size = self.samples[-1]
+        if end - start < THROUGHPUT_MIN_TIME:
+            return None
+        return (end_size - start_size) / (end - start)
+
+
+class SongDownload:
+    '''Download a song (or MV) for one or more AsyncSong objects.
+
+    Player, next-song prefetching and caching daemon may ask for the same
+    song at the same time. They share one download, and all of them
+    receive its signals. Download stops only when all of them quit.
+    '''
+
+    def __init__(self, key, song, use_mv, conf):
+        self.key = key
+        self.song = song
+        self.use_mv = use_mv
+        self.conf = conf
+        self.listeners = []
+        self.lock = threading.Lock()
+        # used to replay signals to AsyncSong objects joined later
+        self.can_play_path = None
+        self.percent = 0
+        # Traffic level registered in bandwidth
+        self.level = None
+        # PartialFile shared with readers
+        self.partial = None
+        # Segments of segmented download, and a function to start one
+        # more connection for it
+        self.segments = None
+        self.spawn_worker = None
+        # seeking in a single stream download, it is turned into a
+        # segmented one to fetch data at this offset.
+        self.seek_offset = None
+
+    @property
+    def force_quit(self):
+        with self.lock:
+            return all(listener.force_quit for listener in self.listeners)
+
+    def get_level(self):
+        '''Traffic level of the most urgent listener.'''
+        with self.lock:
+            levels = [listener.level for listener in self.listeners
+                      if not listener.force_quit]
+        if levels:
+            return min(levels)
+        return Traffic.CACHING
+
+    def throttle(self, size):
+        '''Called after `size` bytes are received.
+
+        Listeners may join later, like the player joining a song being
+        cached, so level is checked on each call.
+        '''
+        level = self.get_level()
+        with self.lock:
+            if level != self.level:
+                if self.level is not None:
+                    bandwidth.leave(self.level)
+                bandwidth.enter(level)
+                self.level = level
+        bandwidth.consume(level, size)
+
+    def add_listener(self, listener):
+        '''Called with song_flights_lock held.'''
+        with self.lock:
+            self.listeners.append(listener)
+            percent = self.percent
+            can_play_path = self.can_play_path
+        if percent:
+            self.deliver(listener, 'chunk-received', percent)
+        if can_play_path:
+            self.deliver(listener, 'can-play', can_play_path)
+
+    def emit(self, signal, *args):
+        with self.lock:
+            if signal == 'can-play':
+                self.can_play_path = args[0]
+            elif signal == 'chunk-received':
+                self.percent = args[0]
+            listeners = list(self.listeners)
+        for listener in listeners:
+            if not listener.force_quit:
+                self.deliver(listener, signal, *args)
+
+    def deliver(self, listener, signal, *args):
+        '''Signals of AsyncSong are emitted in Gtk main thread.'''
+        def do_deliver():
+            if not listener.force_quit:
+                listener.emit(signal, *args)
+
+        if signal == 'chunk-received':
+            # only the latest progress matters
+            key = (id(listener), signal)
+        else:
+            key = None
+        dispatcher.call(do_deliver, key=key)
+
+    def finish(self, *signals):
+        '''Remove this job from song_flights, then emit last signals.'''
+        with song_flights_lock:
+            if song_flights.get(self.key) is self:
+                del song_flights[self.key]
+        for signal in signals:
+            self.emit(*signal)
+
+    def run(self):
+        try:
+            self.download()
+        except Exception:
+            logger.error(traceback.format_exc())
+            self.finish(('network-error', ''))
+        finally:
+            with self.lock:
+                if self.level is not None:
+                    bandwidth.leave(self.level)
+                    self.level = None
+            self.close_partial()
+
+    def open_partial(self, tmp_song_path, content_length, received=0,
+                     segments=None):
+        '''Let readers read tmp_song_path while it is being downloaded.
+
+        When retrying, or turning into a segmented download, readers keep
+        waiting on the same PartialFile.
+        '''
+        if self.partial:
+            self.partial.reset(content_length, received, segments)
+            return
+        self.partial = PartialFile(tmp_song_path, content_length, segments)
+        self.partial.seek_handler = self.seek
+        self.partial.update(received)
+        with partial_files_lock:
+            partial_files[tmp_song_path] = self.partial
+
+    def seek(self, offset):
+        '''Player seeks to offset of file, which is not received yet.
+
+        Called in thread of reader.
+        '''
+        segments = self.segments
+        # both are reset by download thread at any time
+        spawn_worker = self.spawn_worker
+        if segments:
+            if segments.split(offset) and spawn_worker:
+                spawn_worker()
+        elif self.partial and offset - self.partial.received >= SEEK_GAP:
+            self.seek_offset = offset
+
+    def close_partial(self):
+        if not self.partial:
+            return
+        self.partial.close()
+        with partial_files_lock:
+            if partial_files.get(self.partial.part_path) is self.partial:
+                del partial_files[self.partial.part_path]
+
+    def download(self):
+        song = self.song
+        use_mv = self.use_mv
+        cached, song_link, song_path = get_song_link(song, self.conf,
+                                                     use_mv=use_mv)
+        if cached and not os.path.exists(song_path):
+            # removed by user
+            remove_song_file(song_path)
+            cached, song_link, song_path = get_song_link(song, self.conf,
+                                                         use_mv=use_mv)
+        # temp file to store data, kept across retries and restarts
+        tmp_song_path = get_part_path(song_path)
+
+        # check song already cached 
+        if cached:
+            self.finish(('can-play', song_path), ('downloaded', song_path))
+            return
+
+        # this song has no link to download
+        if not song_link:
+            logger.debug('download_song(): %s.' % song)
+            self.finish(('network-error', song_link))
+            return
+
+        if use_mv:
+            self.chunk_to_play = CHUNK_MV_TO_PLAY
+        else:
+            self.chunk_to_play = CHUNK_TO_PLAY
+        # MVs and lossless songs are large, download them with several
+        # connections if server supports Range requests.
+        self.segmented = use_mv or song_path.endswith('.flac')
+        self.can_play_emited = False
+        # bytes per second, 0 if unknown
+        self.bitrate = BITRATES.get(self.key[1], 0) * 1000 // 8
+
+        for retried in range(RETRIES):
+            if retried and network.is_offline():
+                break
+            self.throughput = Throughput()
+            try:
+                part_info = load_part_info(tmp_song_path)
+                if part_info and 'segments' in part_info:
+                    done = self.download_segments(song_link, tmp_song_path,
+                                                  song_path, part_info)
+                else:
+                    done = self.download_stream(song_link, tmp_song_path,
+                                                song_path, part_info)
+                if done:
+                    return
+            except URLError:
+                logger.error(traceback.format_exc())
+            except OSError:
+                logger.error(traceback.format_exc())
+                remove_part(tmp_song_path)
+                self.finish(('disk-error', song_path))
+                return
+
+        # partial file is kept, to be resumed later.
+        self.finish(('network-error', song_link))
+
+    def emit_progress(self, received_size, content_length, tmp_song_path,
+                      playable_size=None):
+        '''Emit chunk-received and can-play signals.
+
+        playable_size - size of data received from the beginning of file,
+                        default is received_size.
+        '''
+        if playable_size is None:
+            playable_size = received_size
+        percent = received_size / content_length
+        self.emit('chunk-received', percent)
+        self.throughput.add(received_size)
+        # this signal only emit once.
+        if (not self.can_play_emited and
+                self.is_playable(received_size, content_length,
+                                 playable_size)):
+            self.emit('can-play', tmp_song_path)
+            self.can_play_emited = True
+
+    def is_playable(self, received_size, content_length, playable_size):
+        '''Check whether playback can start without running out of data.
+
+        If bitrate of song is known, playback starts as soon as the
+        projected download finish time, at current throughput, is well
+        ahead of the duration of song. Else, use fixed thresholds.
+        '''
+        if playable_size >= content_length:
+            return True
+        if playable_size < CHUNK_MIN_TO_PLAY:
+            return False
+        rate = self.throughput.rate()
+        if not self.bitrate or rate is None:
+            return (playable_size > self.chunk_to_play or
+                    playable_size / content_length > 0.4)
+        if not rate:
+            return False
+        finish_time = (content_length - received_size) / rate
+        duration = content_length / self.bitrate
+        return finish_time * CAN_PLAY_MARGIN < duration
+
+    def download_stream(self, song_link, tmp_song_path, song_path,
+                        part_info):
+        '''Download in one connection, resume partial file if possible.
+
+        Returns True if finished, False to retry.
+        '''
+        if part_info and os.path.exists(tmp_song_path):
+            received_size = os.path.getsize(tmp_song_path)
+        else:
+            received_size = 0
+        if received_size and received_size == part_info['length']:
+            # Downloaded in last session, but not renamed.
+            self.downloaded(tmp_song_path, song_path, received_size)
+            return True
+
+        headers = None
+        if received_size:
+            headers = {'Range': 'bytes={0}-'.format(received_size)}
+            validator = (part_info.get('etag') or
+                         part_info.get('last-modified'))
+            if validator:
+                # Server sends the whole file if it has changed.
+                headers['If-Range'] = validator
+        elif self.segmented:
+            # Ask for the head segment first, if server does not support
+            # Range, the whole file is sent back.
+            headers = {'Range': 'bytes=0-{0}'.format(SEGMENT_SIZE - 1)}
+        try:
+            req = http_pool.request(song_link, headers)
+        except HTTPError as e:
+            if e.code != 416 or not received_size:
+                raise
+            # Range Not Satisfiable, partial file is broken.
+            remove_part(tmp_song_path)
+            return False
+
+        content_range = None
+        if req.status == 206:
+            content_range = parse_content_range(
+                    req.getheader('Content-Range'))
+        ranges_supported = (req.status == 206 or
+                            req.getheader('Accept-Ranges') == 'bytes')
+        self.seek_offset = None
+        if req.status == 206 and received_size:
+            if content_range != (received_size, part_info['length']):
+                logger.warn('Net.download_stream(): unexpected ' +
+                            'Content-Range: %s, %s' %
+                            (content_range, tmp_song_path))
+                req.close()
+                remove_part(tmp_song_path)
+                return False
+            content_length = part_info['length']
+            fh = open(tmp_song_path, 'ab')
+            self.open_partial(tmp_song_path, content_length, received_size)
+        elif req.status == 206:
+            if not content_range or content_range[0] != 0:
+                req.close()
+                self.segmented = False
+                return False
+            part_info = {
+                'url': song_link,
+                'length': content_range[1],
+                'etag': req.getheader('ETag'),
+                'last-modified': req.getheader('Last-Modified'),
+            }
+            return self.download_segments(song_link, tmp_song_path,
+                                          song_path, part_info, head=req)
+        else:
+            if received_size:
+                logger.info('Net.download_stream(): %s changed on server' %
+                            song_link)
+            received_size = 0
+            content_length = int(req.getheader('Content-Length'))
+            fh = open(tmp_song_path, 'wb')
+            dump_part_info(tmp_song_path, {
+                'url': song_link,
+                'length': content_length,
+                'etag': req.getheader('ETag'),
+                'last-modified': req.getheader('Last-Modified'),
+            })
+            self.open_partial(tmp_song_path, content_length)
+
+        with fh:
+            while True:
+                if self.force_quit:
+                    # partial file is kept, to be resumed later.
+                    req.close()
+                    self.finish()
+                    return True
+                if self.seek_offset is not None and ranges_supported:
+                    break
+                chunk = req.read(CHUNK)
+                if not chunk:
+                    break
+                fh.write(chunk)
+                # so that player can read all received data
+                fh.flush()
+                received_size += len(chunk)
+                self.partial.update(received_size)
+                self.throttle(len(chunk))
+                self.emit_progress(received_size, content_length,
+                                   tmp_song_path)
+
+        if self.seek_offset is not None and ranges_supported:
+            # Fetch data after seeking offset with another connection,
+            # and data before it later.
+            req.close()
+            part_info = load_part_info(tmp_song_path)
+            part_info['segments'] = [[received_size, content_length - 1]]
+            with open(tmp_song_path, 'r+b') as fh:
+                preallocate(fh, content_length)
+            dump_part_info(tmp_song_path, part_info)
+            return self.download_segments(song_link, tmp_song_path,
+                                          song_path, part_info)
+
+        # download successfully
+        if received_size == content_length:
+            self.downloaded(tmp_song_path, song_path, content_length)
+            return True
+        logger.warn('Net.received_size: %s, content_length: %s' %
+                    (received_size, content_length))
+        if received_size > content_length:
+            remove_part(tmp_song_path)
+        return False
+
+    def download_segments(self, song_link, tmp_song_path, song_path,
+                          part_info, head=None):
+        '''Download byte ranges of file with SEGMENT_CONNS connections.
+
+        File is preallocated, and split into segments of SEGMENT_SIZE.
+        Segments are fetched in order, so data from the beginning of file
+        arrives first, and can-play is emitted early.
+        Segments left are saved in sidecar, so that they are resumed later.
+
+        head - response of the first segment, if this is a new download.
+        Returns True if finished, False to retry.
+        '''
+        content_length = part_info['length']
+        if head:
+            part_info['segments'] = [
+                [start, min(start + SEGMENT_SIZE, content_length) - 1]
+                for start in range(0, content_length, SEGMENT_SIZE)]
+            with open(tmp_song_path, 'wb') as fh:
+                preallocate(fh, content_length)
+            dump_part_info(tmp_song_path, part_info)
+        elif (not os.path.exists(tmp_song_path) or
+                os.path.getsize(tmp_song_path) != content_length):
+            remove_part(tmp_song_path)
+            return False
+
+        segments = Segments(part_info['segments'], content_length)
+        if self.seek_offset is not None:
+            segments.split(self.seek_offset)
+            self.seek_offset = None
+        self.open_partial(tmp_song_path, content_length, segments=segments)
+        self.segments = segments
+        validator = part_info.get('etag') or part_info.get('last-modified')
+
+        def save_segments():
+            part_info['segments'] = segments.remaining()
+            dump_part_info(tmp_song_path, part_info)
+
+        def fetch_segments():
+            while not segments.stopped:
+                segment = segments.take()
+                if not segment:
+                    return
+                try:
+                    if head and segment[0] == 0 and not segments.head_used:
+                        segments.head_used = True
+                        req = head
+                    else:
+                        headers = {'Range': 'bytes={0}-{1}'.format(*segment)}
+                        if validator:
+                            headers['If-Range'] = validator
+                        req = http_pool.request(song_link, headers)
+                        content_range = None
+                        if req.status == 206:
+                            content_range = parse_content_range(
+                                    req.getheader('Content-Range'))
+                        if content_range != (segment[0], content_length):
+                            # file changed on server
+                            req.close()
+                            segments.stop('changed')
+                            segments.release(segment)
+                            return
+                    with open(tmp_song_path, 'r+b') as fh:
+                        fh.seek(segment[0])
+                        while segment[0] <= segment[1]:
+                            if segments.stopped or self.force_quit:
+                                req.close()
+                                break
+                            chunk = req.read(min(CHUNK,
+                                                 segment[1] - segment[0] + 1))
+                            if not chunk:
+                                break
+                            fh.write(chunk)
+                            fh.flush()
+                            segments.advance(segment, len(chunk))
+                            self.partial.update()
+                            self.throttle(len(chunk))
+                    # segment may be shortened by split()
+                    req.close()
+                    if segment[0] > segment[1]:
+                        segments.done(segment)
+                        save_segments()
+                    else:
+                        segments.release(segment)
+                        if not self.force_quit:
+                            segments.stop('network')
+                except URLError:
+                    logger.error(traceback.format_exc())
+                    segments.release(segment)
+                    segments.stop('network')
+                except OSError:
+                    logger.error(traceback.format_exc())
+                    segments.release(segment)
+                    segments.stop('disk')
+
+        def spawn_worker():
+            with workers_lock:
+                alive = [worker for worker in workers if worker.is_alive()]
+                # one more connection is allowed for seeking
+                if len(alive) > SEGMENT_CONNS:
+                    return
+                worker = threading.Thread(target=fetch_segments)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+        workers = []
+        workers_lock = threading.Lock()
+        self.spawn_worker = spawn_worker
+        for i in range(SEGMENT_CONNS):
+            spawn_worker()
+        while any(worker.is_alive() for worker in list(workers)):
+            segments.wait(0.5)
+            if self.force_quit:
+                segments.stop('quit')
+            else:
+                self.emit_progress(segments.received(), content_length,
+                                   tmp_song_path, segments.playable())
+        self.segments = None
+        self.spawn_worker = None
+        for worker in list(workers):
+            worker.join()
+        if head and not segments.head_used:
+            head.close()
+
+        if segments.error == 'changed':
+            logger.info('Net.download_segments(): %s changed on server' %
+                        song_link)
+            remove_part(tmp_song_path)
+            return False
+        if segments.error == 'disk':
+            raise OSError('Failed to write %s' % tmp_song_path)
+        save_segments()
+        if self.force_quit:
+            self.finish()
+            return True
+        if segments.remaining():
+            return False
+        self.emit_progress(content_length, content_length, tmp_song_path)
+        self.downloaded(tmp_song_path, song_path, content_length)
+        return True
+
+    def downloaded(self, tmp_song_path, song_path, content_length):
+        os.rename(tmp_song_path, song_path)
+        if self.partial:
+            self.partial.finish(song_path)
+        if not self.can_play_emited:
+            # partial file completed in last session
+            self.emit('can-play', song_path)
+            self.can_play_emited = True
+        remove_part(tmp_song_path)
+        if self.use_mv:
+            mv_quota.add(song_path, content_length)
+        else:
+            song_quota.add(song_path, content_length)
+        library.add(self.key[0], self.key[1], song_path, content_length)
+        self.finish(('downloaded', song_path))
+        Utils.iconvtag(song_path, self.song)
+
+
 class AsyncSong(GObject.GObject):
     '''Download song(including MV).
 
@@ -777,6 +2524,7 @@ class AsyncSong(GObject.GObject):
     downloading process.
     `downloaded` signal may be used to popup a message to notify 
     user that a new song is downloaded.
+    All signals are emitted in Gtk main thread, through dispatcher.
     '''
     __gsignals__ = {
         'can-play': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE, (str, )),
@@ -787,9 +2535,11 @@ class AsyncSong(GObject.GObject):
         'network-error': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE, (str, )),
     }
 
-    def __init__(self, app):
+    def __init__(self, app, level=Traffic.FOREGROUND):
         super().__init__()
         self.app = app
+        # Traffic level, used to share bandwidth with other downloads
+        self.level = level
         self.force_quit = False
 
     def destroy(self):
@@ -799,88 +2549,24 @@ class AsyncSong(GObject.GObject):
         '''Get the actual link of music file.
 
         If higher quality of that music unavailable, a lower one is used.
+        If this song is being downloaded by another AsyncSong object, just
+        join that download.
+        Downloading may take minutes, so it runs in its own thread instead
+        of blocking a worker of async_call().
         '''
-        async_call(self._download_song, song, use_mv)
-
-    def _download_song(self, song, use_mv):
-        cached, song_link, song_path = get_song_link(song, self.app.conf,
-                                                     use_mv=use_mv)
-        # temp file to store data
-        tmp_song_path = '{0}-{1}.part'.format(song_path, int(time.time()))
-
-        # check song already cached 
-        if cached:
-            self.emit('can-play', song_path)
-            self.emit('downloaded', song_path)
-            return
-
-        # this song has no link to download
-        if not song_link:
-            logger.debug('download_song(): %s.' % song)
-            self.emit('network-error', song_link)
-            return
-
-        if use_mv:
-            chunk_to_play = CHUNK_MV_TO_PLAY
-        else:
-            chunk_to_play = CHUNK_TO_PLAY
-
-        for retried in range(RETRIES):
-            try:
-                req = request.urlopen(song_link, timeout=TIMEOUT)
-                received_size = 0
-                can_play_emited = False
-                content_length = int(req.headers.get('Content-Length'))
-                fh = open(tmp_song_path, 'wb')
-
-                while True:
-                    if self.force_quit:
-                        if not fh.closed:
-                            fh.close()
-                        if os.path.exists(song_path):
-                            os.remove(song_path)
-                        return
-                    chunk = req.read(CHUNK)
-                    received_size += len(chunk)
-                    percent = received_size / content_length
-                    if int(percent * 100) % 5 == 0:
-                        self.emit('chunk-received', percent)
-                    # this signal only emit once.
-                    if ((received_size > chunk_to_play or percent > 0.4) and
-                            not can_play_emited):
-                        self.emit('can-play', tmp_song_path)
-                        can_play_emited = True
-                    if not chunk:
-                        break
-                    fh.write(chunk)
-
-                fh.close()
-                # download successfully
-                if received_size == content_length:
-                    os.rename(tmp_song_path, song_path)
-                    self.emit('downloaded', song_path)
-                    Utils.iconvtag(song_path, song)
-                    return
-                else:
-                    logger.warn('Net.received_size: %s, content_length: %s' %
-                                (received_size, content_length))
-                    self.emit('network-error', song_link)
-                # remove temp file
-                if os.path.exists(tmp_song_path):
-                    os.remove(tmp_song_path)
-                break
-
-            except URLError:
-                logger.error(traceback.format_exc())
-            except FileNotFoundError:
-                logger.error(traceback.format_exc())
-                self.emit('disk-error', song_path)
-                if os.path.exists(tmp_song_path):
-                    os.remove(tmp_song_path)
+        br, ext = get_song_format(song, self.app.conf, use_mv)
+        key = (str(song['rid']), br)
+        with song_flights_lock:
+            job = song_flights.get(key)
+            if job:
+                job.add_listener(self)
                 return
+            job = SongDownload(key, song, use_mv, self.app.conf)
+            job.add_listener(self)
+            song_flights[key] = job
 
-        if os.path.exists(tmp_song_path):
-            os.remove(tmp_song_path)
-        self.emit('network-error', song_link)
+        thread = threading.Thread(target=job.run)
+        thread.daemon = True
+        thread.start()
 
 GObject.type_register(AsyncSong)
@@ -10,7 +10,6 @@ import random
 import shutil
 import threading
 import time
-import traceback
 
 from gi.repository import Gdk
 from gi.repository import GdkPixbuf
@@ -34,13 +33,17 @@ DRAG_TARGETS = [
 ]
 DRAG_ACTIONS = Gdk.DragAction.MOVE
 
-def get_song_paths(artist, name, conf):
-    song_name = (artist + '-' + name).replace('/', '+')
-    return (
+def get_song_paths(rid, artist, name, conf):
+    '''Paths of cached files of this song, and where older versions
+    saved them.'''
+    song_name = Net.get_song_name({'artist': artist, 'name': name})
+    paths = Net.library.get_paths(str(rid))
+    paths.extend((
         os.path.join(conf['song-dir'], song_name) + '.mp3',
         os.path.join(conf['song-dir'], song_name) + '.flac',
         os.path.join(conf['mv-dir'], song_name) + '.mp4',
-    )
+    ))
+    return paths
 
 
 class TreeViewColumnText(Widgets.TreeViewColumnText):
@@ -97,6 +100,15 @@ class NormalSongTab(Gtk.ScrolledWindow):
                                        text=self.COL_ALBUM)
         self.treeview.append_column(album_col)
 
+        if list_name == 'Caching':
+            # progress of songs being cached, rid -> percent
+            self.progress = {}
+            progress_cell = Gtk.CellRendererProgress()
+            progress_col = Gtk.TreeViewColumn(_('Progress'), progress_cell)
+            progress_col.set_cell_data_func(progress_cell,
+                                            self.on_progress_cell_data)
+            self.treeview.append_column(progress_col)
+
         delete_cell = Gtk.CellRendererPixbuf(icon_name='user-trash-symbolic')
         self.delete_col = Widgets.TreeViewColumnIcon(_('Delete'), delete_cell)
         self.treeview.append_column(self.delete_col)
@@ -156,6 +168,28 @@ class NormalSongTab(Gtk.ScrolledWindow):
             return
         self.liststore.remove(self.liststore.get_iter(path))
 
+    def on_progress_cell_data(self, column, cell, model, tree_iter, data):
+        percent = self.progress.get(model[tree_iter][self.RID])
+        cell.props.visible = percent is not None
+        if percent is not None:
+            cell.props.value = int(percent * 100)
+
+    def set_progress(self, rid, percent):
+        '''Update download progress of a song, None to hide it.'''
+        if percent is None:
+            self.progress.pop(rid, None)
+        else:
+            self.progress[rid] = percent
+        self.treeview.queue_draw()
+
+    def remove_song(self, rid):
+        '''Remove row of song with rid, returns True if found.'''
+        for row in self.liststore:
+            if row[self.RID] == rid:
+                self.liststore.remove(row.iter)
+                return True
+        return False
+
     def on_treeview_row_activated(self, treeview, path, column):
         model = treeview.get_model()
         index = treeview.get_columns().index(column)
@@ -213,11 +247,10 @@ class NormalSongTab(Gtk.ScrolledWindow):
         selection = self.treeview.get_selection()
         liststore, paths = selection.get_selected_rows()
         for path in paths:
-            filepaths = get_song_paths(self.liststore[path][1],
-                                       self.liststore[path][0], self.app.conf)
+            row = self.liststore[path]
+            filepaths = get_song_paths(row[3], row[1], row[0], self.app.conf)
             for filepath in filepaths:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                Net.remove_song_file(filepath)
 
 
 class ExportDialog(Gtk.Dialog):
@@ -275,14 +308,15 @@ class ExportDialog(Gtk.Dialog):
 
     def do_export(self, button):
         def on_song_copied(worker, name, percent):
-            GLib.idle_add(do_on_song_copied, name, percent)
+            Net.dispatcher.call(do_on_song_copied, name, percent,
+                                key=('export', 'song-copied'))
 
         def do_on_song_copied(name, percent):
             self.export_prog.set_fraction(percent)
             self.export_prog.set_text(name)
 
         def on_worker_finished(worker, file_nums):
-            GLib.idle_add(do_on_worker_finished)
+            Net.dispatcher.call(do_on_worker_finished)
 
         def do_on_worker_finished():
             self.export_worker = None
@@ -339,8 +373,8 @@ class ExportWorker(threading.Thread, GObject.GObject):
             if self.stop_flag:
                 return
             song = Widgets.song_row_to_dict(item, start=0)
-            cached, song_link, song_path = Net.get_song_link(song, self.conf)
-            if not cached:
+            song_path = Net.get_cached_song(song, self.conf)
+            if not song_path:
                 continue
             shutil.copy(song_path, self.export_dir)
             if self.including_lrc:
@@ -369,9 +403,11 @@ class PlayList(Gtk.Box):
         # use curr_playing to locate song in treeview, [model, iter]
         self.curr_playing = [None, None]
 
-        # control cache job
+        # control cache jobs, rid -> AsyncSong
         self.cache_enabled = False
-        self.cache_job = None
+        self.cache_jobs = {}
+        # songs failed to download, skipped until cache service restarts
+        self.cache_failed = set()
         self.cache_global_count = 0
         self.cache_local_count = 0
 
@@ -438,8 +474,8 @@ class PlayList(Gtk.Box):
 
     def do_destroy(self):
         self.dump_playlists()
-        if self.cache_job:
-            self.cache_job.destroy()
+        for cache_job in self.cache_jobs.values():
+            cache_job.destroy()
 
     def first(self):
         selection = self.treeview_left.get_selection()
@@ -657,6 +693,7 @@ class PlayList(Gtk.Box):
         if not self.cache_enabled:
             self.cache_speed_label.show()
             self.cache_enabled = True
+            self.cache_failed.clear()
             self.cache_global_count = 0
             self.cache_local_count = 0
             self.button_start.set_label(_('Stop Cache Service'))
@@ -669,75 +706,84 @@ class PlayList(Gtk.Box):
         self.cache_local_count = 0
         self.cache_speed_label.hide()
         self.button_start.set_label(_('Start Cache Service'))
-        if self.cache_job:
-            self.cache_job.destroy()
-            self.cache_job = None
+        caching_tab = self.tabs['Caching']
+        for rid, cache_job in self.cache_jobs.items():
+            cache_job.destroy()
+            caching_tab.set_progress(rid, None)
+        self.cache_jobs.clear()
 
     def do_cache_song_pool(self):
-        def _remove_song():
-            try:
-                liststore.remove(liststore.get_iter(path))
-            except IndexError:
-                logger.error(traceback.format_exc())
-            Gdk.Window.process_all_updates()
+        '''Download songs in Caching list, cache-jobs songs at a time.
+
+        Songs are taken from top of the list. When a song is downloaded,
+        its row is removed and the next song is started.
+        '''
+        def _finish_job(rid):
+            cache_job = self.cache_jobs.pop(rid, None)
+            if cache_job:
+                cache_job.destroy()
+            caching_tab.set_progress(rid, None)
+
+        def _on_disk_error(widget, song_path, rid):
+            logger.warn('Playlist.on_disk_error: %s' % song_path)
+            self.stop_caching_daemon()
+            Widgets.filesystem_error(self.app.window, song_path)
+
+        def _on_network_error(widget, song_link, rid):
+            logger.warn('Playlist.on_network_error: %s, %s' %
+                        (song_link, rid))
+            _finish_job(rid)
+            # try it again when network is back
+            if not Net.network.is_offline():
+                self.cache_failed.add(rid)
+            self.do_cache_song_pool()
 
-        def _on_disk_error(widget, song_path, eror=None):
-            def on_disk_error():
-                logger.warn('Playlist.on_disk_error: %s, %s' %
-                            (song_path, error))
-                self.stop_caching_daemon()
-                Widgets.filesystem_error(self.app.window, song_path)
-            GLib.idle_add(on_disk_error)
-
-        def _on_network_error(widget, song_link, error=None):
-            def on_network_error():
-                logger.warn('Playlist.on_network_error: %s, %s' %
-                            (song_link, error))
-                self.stop_caching_daemon()
-                Widgets.network_error(self.app.window,
-                                      _('Failed to cache song'))
-            GLib.idle_add(on_network_error)
-
-        def _on_chunk_received(widget, percent):
-            def on_chunk_received():
-                self.cache_local_count += 1
-                self.cache_speed_label.set_text(
-                        '{0} %'.format(int(percent * 100)))
-            GLib.idle_add(on_chunk_received)
-
-        def _on_downloaded(widget, song_path, error=None):
-            def on_downloaded():
-                if song_path:
-                    _remove_song()
-                if self.cache_enabled:
-                    self.do_cache_song_pool()
-            GLib.idle_add(on_downloaded)
+        def _on_chunk_received(widget, percent, rid):
+            self.cache_local_count += 1
+            caching_tab.set_progress(rid, percent)
 
-        if not self.cache_enabled:
+        def _on_downloaded(widget, song_path, rid):
+            _finish_job(rid)
+            if song_path:
+                caching_tab.remove_song(rid)
+            self.do_cache_song_pool()
+
+        if not self.cache_enabled or Net.network.is_offline():
             return
-        self.cache_local_count = 0
-        self.cache_global_count = 0
-        self.cache_speed_label.set_text('0 %')
-        list_name = 'Caching'
-        liststore = self.tabs[list_name].liststore
-        path = 0
-        if len(liststore) == 0:
-            logger.info('Caching playlist is empty, please add some songs')
-            self.stop_caching_daemon()
-            Notify.init('kwplayer-cache')
-            notify = Notify.Notification.new('Kwplayer',
-                    _('All songs in caching list have been downloaded.'),
-                    'kwplayer')
-            notify.show()
+        caching_tab = self.tabs['Caching']
+        liststore = caching_tab.liststore
+        max_jobs = max(1, self.app.conf['cache-jobs'])
+        for row in liststore:
+            if len(self.cache_jobs) >= max_jobs:
+                break
+            song = Widgets.song_row_to_dict(row, start=0)
+            rid = song['rid']
+            if rid in self.cache_jobs or rid in self.cache_failed:
+                continue
+            logger.debug('will download: %s' % song)
+            cache_job = Net.AsyncSong(self.app, Net.Traffic.CACHING)
+            cache_job.connect('chunk-received', _on_chunk_received, rid)
+            cache_job.connect('downloaded', _on_downloaded, rid)
+            cache_job.connect('disk-error', _on_disk_error, rid)
+            cache_job.connect('network-error', _on_network_error, rid)
+            self.cache_jobs[rid] = cache_job
+            caching_tab.set_progress(rid, 0)
+            cache_job.get_song(song)
+
+        if self.cache_jobs:
+            self.cache_speed_label.set_text(
+                    _('Downloading {0} songs').format(len(self.cache_jobs)))
             return
-        song = Widgets.song_row_to_dict(liststore[path], start=0)
-        logger.debug('will download: %s' % song)
-        self.cache_job = Net.AsyncSong(self.app)
-        self.cache_job.connect('chunk-received', _on_chunk_received)
-        self.cache_job.connect('downloaded', _on_downloaded)
-        self.cache_job.connect('disk-error', _on_disk_error)
-        self.cache_job.connect('network-error', _on_network_error)
-        self.cache_job.get_song(song)
+        self.stop_caching_daemon()
+        if self.cache_failed:
+            Widgets.network_error(self.app.window, _('Failed to cache song'))
+            return
+        logger.info('Caching playlist is empty, please add some songs')
+        Notify.init('kwplayer-cache')
+        notify = Notify.Notification.new('Kwplayer',
+                _('All songs in caching list have been downloaded.'),
+                'kwplayer')
+        notify.show()
 
     # Others
     def on_song_downloaded(self, play=False):
@@ -767,9 +813,26 @@ class PlayList(Gtk.Box):
                 pos = 0
         else:
             pos = pos - 1
+        if Net.network.is_offline():
+            pos = self.get_cached_pos(liststore, pos, -1, repeat)
+            if pos is None:
+                return None
         self.prev_playing = liststore.get_iter(Gtk.TreePath(pos))
         return Widgets.song_row_to_dict(liststore[pos], start=0)
 
+    def get_protected_paths(self):
+        '''Paths of all songs in playlists, including Caching list.
+
+        User keeps these songs, App.check_disk_quotas() passes them to
+        enforce_quotas() as protected.
+        '''
+        paths = []
+        for tab in self.tabs.values():
+            for row in tab.liststore:
+                paths.extend(get_song_paths(row[3], row[1], row[0],
+                                            self.app.conf))
+        return paths
+
     def get_next_song(self, repeat, shuffle):
         list_name = self.curr_playing[0]
         liststore = self.tabs[list_name].liststore
@@ -788,10 +851,32 @@ class PlayList(Gtk.Box):
             pos = 0
         else:
             pos = pos + 1
+        if Net.network.is_offline():
+            pos = self.get_cached_pos(liststore, pos, 1, repeat or shuffle)
+            if pos is None:
+                return None
 
         self.next_playing = liststore.get_iter(Gtk.TreePath(pos))
         return Widgets.song_row_to_dict(liststore[pos], start=0)
 
+    def get_cached_pos(self, liststore, pos, step, repeat):
+        '''In offline mode, find the first cached song from pos.
+
+        step is 1 to look forward, -1 backward. Returns None if no song
+        is cached.
+        '''
+        song_nums = len(liststore)
+        for i in range(song_nums):
+            song = Widgets.song_row_to_dict(liststore[pos], start=0)
+            if Net.get_cached_song(song, self.app.conf):
+                return pos
+            pos += step
+            if pos < 0 or pos >= song_nums:
+                if not repeat:
+                    return None
+                pos %= song_nums
+        return None
+
     def play_prev_song(self, repeat, use_mv=False):
         prev_song = self.get_prev_song(repeat)
         if not prev_song:
@@ -812,6 +897,14 @@ class PlayList(Gtk.Box):
         else:
             self.app.player.load(next_song)
 
+    def skip_to_next_song(self):
+        '''Move curr_playing to next_playing.
+
+        Called when player has switched to the queued next song by itself,
+        so the song is not loaded again.
+        '''
+        self.curr_playing[1] = self.next_playing
+
     def locate_curr_song(self, popup_page=True):
         '''switch current playlist and select curr_song.'''
         list_name = self.curr_playing[0]
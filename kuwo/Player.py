@@ -8,7 +8,6 @@ import sys
 import time
 
 from gi.repository import Gdk
-from gi.repository import GdkPixbuf
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
@@ -19,6 +18,7 @@ from kuwo.Preferences import Preferences
 from kuwo.PlayerBin import PlayerBin
 from kuwo.PlayerDBus import PlayerDBus
 from kuwo.PlayerNotify import PlayerNotify
+from kuwo.PlayList import get_song_paths
 from kuwo import Widgets
 from kuwo.log import logger
 
@@ -60,6 +60,13 @@ class Player(Gtk.Box):
         self.adj_timeout = 0
         self.recommend_imgs = None
         self.curr_song = None
+        self.next_song = None
+        # local files of curr_song and next_song, when downloaded
+        self.curr_song_path = None
+        self.next_song_path = None
+        # (song, song_path) queued in playbin, to be played without a gap
+        self.queued_song = None
+        self.meta_url = ''
         self.fullscreen_sid = 0
         self.fullscreen_timestamp = 0
         self.default_cursor = None
@@ -170,6 +177,10 @@ class Player(Gtk.Box):
         pref_item = Gtk.MenuItem(label=_('Preferences'))
         pref_item.connect('activate', self.on_main_menu_pref_activate)
         main_menu.append(pref_item)
+        offline_item = Gtk.CheckMenuItem(label=_('Offline Mode'))
+        offline_item.set_active(self.app.conf['offline'])
+        offline_item.connect('toggled', self.on_main_menu_offline_toggled)
+        main_menu.append(offline_item)
         sep_item = Gtk.SeparatorMenuItem()
         main_menu.append(sep_item)
 
@@ -243,10 +254,12 @@ class Player(Gtk.Box):
         self.playbin.set_volume(self.app.conf['volume'] ** 0.33)
         self.playbin.connect('eos', self.on_playbin_eos)
         self.playbin.connect('error', self.on_playbin_error)
+        self.playbin.connect('track-changed', self.on_playbin_track_changed)
         self.playbin.connect('mute-changed', self.on_playbin_mute_changed)
         self.playbin.connect('volume-changed', self.on_playbin_volume_changed)
         self.dbus = PlayerDBus(self)
         self.notify = PlayerNotify(self)
+        Net.network.listeners.append(self.on_network_changed)
 
     def after_init(self):
         self.init_meta()
@@ -271,7 +284,8 @@ class Player(Gtk.Box):
     def create_new_async(self, *args, **kwds):
         self.scale.set_fill_level(0)
         self.scale.set_show_fill_level(True)
-        self.scale.set_restrict_to_fill_level(True)
+        # Data after seeking position is fetched at once.
+        self.scale.set_restrict_to_fill_level(False)
         self.adjustment.set_lower(0.0)
         self.adjustment.set_upper(100.0)
         if self.async_song:
@@ -285,77 +299,79 @@ class Player(Gtk.Box):
         self.async_song.get_song(*args, **kwds)
 
     def on_chunk_received(self, widget, percent):
-        def _update_fill_level():
-            self.scale.set_fill_level(percent * self.adjustment.get_upper())
-        GLib.idle_add(_update_fill_level)
+        self.scale.set_fill_level(percent * self.adjustment.get_upper())
 
     def on_song_disk_error(self, widget, song_path):
         '''Disk error: occurs when disk is not available.'''
-        GLib.idle_add(Widgets.filesystem_error, self.app.window, song_path)
+        Widgets.filesystem_error(self.app.window, song_path)
         self.stop_player_cb()
 
     def on_song_network_error(self, widget, song_link):
         '''Failed to get source link, or failed to download song'''
         self.stop_player_cb()
+        if Net.network.is_offline():
+            self.app.toast(_('Offline, this song is not cached'))
+            return
         if self.play_type == PlayType.MV:
             msg = _('Failed to download MV')
         elif self.play_type in (PlayType.SONG, PlayType.RADIO):
             msg = _('Failed to download song')
-        GLib.idle_add(Widgets.network_error, self.app.window, msg)
+        Widgets.network_error(self.app.window, msg)
         self.stop_player_cb()
 
     def on_song_can_play(self, widget, song_path):
-        def _on_song_can_play():
-            uri = 'file://' + song_path
-            self.meta_url = uri
-
-            if self.play_type in (PlayType.SONG, PlayType.RADIO):
-                self.app.lrc.show_music()
-                self.playbin.load_audio(uri)
-                self.get_lrc()
-                self.get_recommend_lists()
-            elif self.play_type == PlayType.MV:
-                self.use_mtv_btn.set_sensitive(True)
-                self.app.lrc.show_mv()
-                self.playbin.load_video(uri, self.app.lrc.xid)
-
-            self.playback_action.set_active(True)
-            self.playbin.set_volume(self.app.conf['volume'])
-            self.init_meta()
-            GLib.timeout_add(1500, self.init_adjustment)
+        self.meta_url = 'file://' + song_path
+        uri = self.playbin.get_file_uri(song_path)
 
-            self.update_player_info()
-            if self.play_type == PlayType.SONG:
-                if self.curr_song.get('formats', ''):
-                    self.use_mtv_btn.set_sensitive(
-                            'MP4' in self.curr_song['formats'])
-                else:
-                    # for v3.4.7, remove this in v3.6.1
-                    self.get_mv_link()
-        GLib.idle_add(_on_song_can_play)
+        if self.play_type in (PlayType.SONG, PlayType.RADIO):
+            self.app.lrc.show_music()
+            self.playbin.load_audio(uri)
+            self.get_lrc()
+            self.get_recommend_lists()
+        elif self.play_type == PlayType.MV:
+            self.use_mtv_btn.set_sensitive(True)
+            self.app.lrc.show_mv()
+            self.playbin.load_video(uri, self.app.lrc.xid)
+
+        self.playback_action.set_active(True)
+        self.playbin.set_volume(self.app.conf['volume'])
+        self.init_meta()
+        GLib.timeout_add(1500, self.init_adjustment)
+
+        self.update_player_info()
+        self.update_mtv_button()
+
+    def update_mtv_button(self):
+        if self.play_type == PlayType.SONG:
+            if self.curr_song.get('formats', ''):
+                self.use_mtv_btn.set_sensitive(
+                        'MP4' in self.curr_song['formats'])
+            else:
+                # for v3.4.7, remove this in v3.6.1
+                self.get_mv_link()
 
     def on_song_downloaded(self, widget, song_path):
-        def _on_song_download():
+        if self.async_song:
             self.async_song.destroy()
             self.async_song = None
-            self.scale.set_fill_level(self.adjustment.get_upper())
-            self.scale.set_show_fill_level(False)
-            self.scale.set_restrict_to_fill_level(False)
-            self.init_adjustment()
-            if self.play_type in (PlayType.SONG, PlayType.MV):
-                self.app.playlist.on_song_downloaded(play=True)
-                self.next_song = self.app.playlist.get_next_song(
-                        self.repeat_btn.get_active(),
-                        self.shuffle_btn.get_active())
-            elif self.play_type == PlayType.RADIO:
-                self.next_song = self.curr_radio_item.get_next_song()
-            if self.next_song:
-                self.cache_next_song()
-            # update metadata in dbus
-            self.dbus.update_meta()
-            self.dbus.enable_seek()
-
-        GLib.idle_add(_on_song_download)
+        self.curr_song_path = song_path
+        self.scale.set_fill_level(self.adjustment.get_upper())
+        self.scale.set_show_fill_level(False)
+        self.scale.set_restrict_to_fill_level(False)
+        self.init_adjustment()
+        if self.play_type in (PlayType.SONG, PlayType.MV):
+            self.app.playlist.on_song_downloaded(play=True)
+            self.next_song = self.app.playlist.get_next_song(
+                    self.repeat_btn.get_active(),
+                    self.shuffle_btn.get_active())
+        elif self.play_type == PlayType.RADIO:
+            self.next_song = self.curr_radio_item.get_next_song()
+        if self.next_song:
+            self.cache_next_song()
+        self.queue_next_song()
+        # update metadata in dbus
+        self.dbus.update_meta()
+        self.dbus.enable_seek()
 
     def cache_next_song(self):
         if self.play_type == PlayType.MV:
@@ -364,9 +380,80 @@ class Player(Gtk.Box):
             use_mv = False
         if self.async_next_song:
             self.async_next_song.destroy()
-        self.async_next_song = Net.AsyncSong(self.app)
+        self.next_song_path = None
+        self.async_next_song = Net.AsyncSong(self.app, Net.Traffic.PREFETCH)
+        self.async_next_song.connect('downloaded',
+                                     self.on_next_song_downloaded)
         self.async_next_song.get_song(self.next_song, use_mv=use_mv)
 
+    def on_next_song_downloaded(self, async_song, song_path):
+        if async_song is not self.async_next_song:
+            return
+        self.next_song_path = song_path
+        self.queue_next_song()
+
+    def queue_next_song(self):
+        '''Queue local file of the song to play next in playbin.
+
+        So that playbin switches to it when current song finishes, without
+        tearing down the pipeline. MV is not queued.
+        '''
+        self.queued_song = None
+        self.playbin.set_next_uri(None)
+        if self.play_type not in (PlayType.SONG, PlayType.RADIO):
+            return
+        if self.repeat_type == RepeatType.ONE:
+            song, song_path = self.curr_song, self.curr_song_path
+        else:
+            song, song_path = self.next_song, self.next_song_path
+        if not song or not song_path:
+            return
+        self.queued_song = (song, song_path)
+        self.playbin.set_next_uri('file://' + song_path)
+
+    def on_playbin_track_changed(self, playbin, uri):
+        '''Queued song starts playing, playbin keeps running.'''
+        if not self.queued_song:
+            return
+        song, song_path = self.queued_song
+        self.queued_song = None
+        if song is not self.curr_song:
+            if self.play_type == PlayType.SONG:
+                self.app.playlist.skip_to_next_song()
+            elif self.play_type == PlayType.RADIO:
+                self.curr_radio_item.skip_to_next_song()
+            self.curr_song = song
+            self.update_favorite_button_status()
+        if self.async_song:
+            self.async_song.destroy()
+            self.async_song = None
+
+        self.init_meta()
+        self.meta_url = 'file://' + song_path
+        self.adjustment.set_value(0)
+        self.app.lrc.show_music()
+        self.get_lrc()
+        self.get_recommend_lists()
+        self.update_player_info()
+        self.update_mtv_button()
+        self.on_song_downloaded(None, song_path)
+        self.notify.refresh()
+
+    def get_protected_paths(self):
+        '''Paths of songs being played or cached as the next song.
+
+        Removing them would break playback in progress, or the gapless
+        switch to the next song.
+        '''
+        paths = []
+        for song in (self.curr_song, self.next_song):
+            if song:
+                paths.extend(get_song_paths(song['rid'], song['artist'],
+                                            song['name'], self.app.conf))
+        if self.meta_url.startswith('file://'):
+            paths.append(self.meta_url[len('file://'):])
+        return paths
+
     def init_adjustment(self):
         self.adjustment.set_value(0.0)
         self.adjustment.set_lower(0.0)
@@ -389,9 +476,6 @@ class Player(Gtk.Box):
         self.adjustment.set_value(offset)
         self.adjustment.set_upper(duration)
         self.sync_label_by_adjustment()
-        if offset >= duration - 800000000:
-            self.load_next()
-            return False
         if self.play_type == PlayType.MV:
             return True
         self.app.lrc.sync_lrc(offset)
@@ -440,6 +524,7 @@ class Player(Gtk.Box):
             self.repeat_type = RepeatType.NONE
             button.set_active(False)
             button.set_icon_name('media-playlist-repeat-symbolic')
+        self.queue_next_song()
 
     def on_scale_change_value(self, scale, scroll_type, value):
         self.app.lrc.reset_tags()
@@ -460,9 +545,8 @@ class Player(Gtk.Box):
                     Widgets.short_tooltip(info['info'], length=500))
             if info['pic']:
                 self.meta_artUrl = info['pic']
-                pix = GdkPixbuf.Pixbuf.new_from_file_at_size(info['pic'],
-                                                             100, 100)
-                self.artist_pic.set_from_pixbuf(pix)
+                if info['pixbuf']:
+                    self.artist_pic.set_from_pixbuf(info['pixbuf'])
             else:
                 self.meta_artUrl = Config.ANONYMOUS_IMG
             self.notify.refresh()
@@ -492,7 +576,8 @@ class Player(Gtk.Box):
                 logger.error('get_lrc(): %s', error)
             self.app.lrc.set_lrc(lrc_text)
 
-        Net.async_call(Net.get_lrc, self.curr_song, callback=_update_lrc)
+        Net.async_call(Net.get_lrc, self.curr_song, callback=_update_lrc,
+                       priority=Net.Priority.PLAYING)
 
     def get_recommend_lists(self):
         self.recommend_imgs = None
@@ -682,11 +767,16 @@ class Player(Gtk.Box):
         dialog = Preferences(self.app)
         dialog.run()
         dialog.destroy()
+        Net.apply_conf(self.app.conf)
         self.app.load_styles()
         self.app.init_status_icon()
         self.app.lrc.update_highlighted_tag()
         self.app.shortcut.rebind_keys()
 
+    def on_main_menu_offline_toggled(self, menu_item):
+        self.app.conf['offline'] = menu_item.get_active()
+        Net.network.set_forced(self.app.conf['offline'])
+
     def on_main_menu_about_activate(self, menu_item):
         dialog = Gtk.AboutDialog()
         dialog.set_modal(True)
@@ -715,6 +805,13 @@ class Player(Gtk.Box):
         self.app.toast('Player Error: %s' % error_msg)
         self.stop_player()
 
+    def on_network_changed(self, offline):
+        '''Network is lost or back, not changed by offline mode.'''
+        if offline:
+            self.app.toast(_('Network is unavailable, playing cached songs'))
+        else:
+            self.app.toast(_('Network is available'))
+
     def on_playbin_mute_changed(self, playbin, mute):
         self.update_gtk_volume_value_cb()
 
@@ -785,6 +882,8 @@ class Player(Gtk.Box):
             return
         self.playback_action.set_active(False)
         self.playbin.stop()
+        self.queued_song = None
+        self.curr_song_path = None
         self.scale.set_value(0)
         if self.play_type != PlayType.MV:
             self.use_audio_btn.handler_block(self.use_audio_sid)
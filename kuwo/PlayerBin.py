@@ -4,8 +4,18 @@
 # Use of this source code is governed by GPLv3 license that can be found
 # in the LICENSE file.
 
+import collections
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import mimetypes
+import os
+import re
+import secrets
+import socketserver
 import sys
+import threading
 import traceback
+from urllib import parse
 
 from gi.repository import Gdk
 from gi.repository import GLib
@@ -18,8 +28,134 @@ from gi.repository import Gtk
 Gst.init(None)
 GST_LOWER_THAN_1 = (Gst.version()[0] < 1)
 
+from kuwo import Net
 from kuwo.log import logger
 
+STREAM_WAIT = 1      # seconds to wait for data in each loop
+STREAM_FILES = 8     # num of recent files kept in stream server
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    '''Serve local song files to playbin, over HTTP.
+
+    Path of url is a random token of the file, only files registered by
+    PlayerBin.get_file_uri() are served, and only to requests sent to
+    127.0.0.1 (not to a rebinded host name). If file is still being
+    downloaded, its full length is sent in headers, and reads block until
+    data arrives. Range requests are supported, so playbin can seek in it.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('StreamHandler: ' + format % args)
+
+    def do_HEAD(self):
+        self.send_file(send_body=False)
+
+    def do_GET(self):
+        self.send_file()
+
+    def send_file(self, send_body=True):
+        host = '127.0.0.1:{0}'.format(self.server.server_address[1])
+        if self.headers.get('Host') != host:
+            self.send_error(403)
+            return
+        token = parse.urlsplit(self.path).path.lstrip('/')
+        with stream_files_lock:
+            partial = stream_files.get(token)
+        if not partial:
+            self.send_error(404)
+            return
+        length = partial.length
+
+        start, end = 0, length - 1
+        match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), length - 1)
+            else:
+                # suffix range, the last n bytes
+                start = max(0, length - int(match.group(2)))
+            if start >= length or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(length))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {0}-{1}/{2}'.format(start, end, length))
+        else:
+            self.send_response(200)
+        content_type = mimetypes.guess_type(
+                partial.part_path[:-len(Net.PART_EXT)])[0]
+        self.send_header('Content-Type',
+                         content_type or 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not send_body:
+            return
+
+        try:
+            self.copy_file(partial, start, end)
+        except (BrokenPipeError, ConnectionResetError):
+            # playbin closes connection when seeking or stopping.
+            pass
+        except OSError:
+            logger.error(traceback.format_exc())
+        self.close_connection = True
+
+    def copy_file(self, partial, start, end):
+        partial.request(start)
+        try:
+            fh = open(partial.path, 'rb')
+        except FileNotFoundError:
+            # renamed just now
+            fh = open(partial.path, 'rb')
+        with fh:
+            fh.seek(start)
+            pos = start
+            while pos <= end:
+                available_end = partial.wait(pos, STREAM_WAIT)
+                if available_end <= pos:
+                    if partial.closed:
+                        return
+                    continue
+                chunk = fh.read(min(Net.CHUNK, available_end - pos,
+                                    end + 1 - pos))
+                if not chunk:
+                    return
+                self.wfile.write(chunk)
+                pos += len(chunk)
+
+
+class StreamServer(socketserver.ThreadingMixIn, HTTPServer):
+    '''HTTP server on loopback, serves files being downloaded.'''
+
+    daemon_threads = True
+
+
+stream_server = None
+stream_server_lock = threading.Lock()
+# token -> Net.PartialFile, files served by stream server
+stream_files = collections.OrderedDict()
+stream_files_lock = threading.Lock()
+
+def get_stream_server():
+    '''Start stream server on first call.'''
+    global stream_server
+    with stream_server_lock:
+        if not stream_server:
+            stream_server = StreamServer(('127.0.0.1', 0), StreamHandler)
+            thread = threading.Thread(target=stream_server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        return stream_server
+
 
 class PlayerBin(GObject.GObject):
     '''Gstreamer wrapper.
@@ -31,12 +167,18 @@ class PlayerBin(GObject.GObject):
         'eos': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE, (bool, )),
         'error': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE, (str, )),
         'mute-changed': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE, (bool, )),
+        'track-changed': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
+                          (str, )),
         'volume-changed': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
                            (float, )),
     }
     xid = None
     bus_sync_sid = 0
     audio_stream = 0
+    # uri to play after current one, without a gap
+    next_uri = None
+    # next_uri handed to playbin, waiting for its stream to start
+    queued_uri = None
 
     def __init__(self):
         super().__init__()
@@ -52,12 +194,39 @@ class PlayerBin(GObject.GObject):
         self.bus.add_signal_watch()
         self.bus.connect('message::eos', self.on_eos)
         self.bus.connect('message::error', self.on_error)
+        self.bus.connect('message::stream-start', self.on_stream_start)
+        self.playbin.connect('about-to-finish', self.on_about_to_finish)
         self.volume_sid = self.playbin.connect('notify::volume',
                                                self.on_volume_changed)
         self.mute_sid = self.playbin.connect('notify::mute',
                                              self.on_mute_changed)
 
     # Open APIs
+    def get_file_uri(self, filepath):
+        '''Get uri of a song file to play.
+
+        Partial files being downloaded are served by stream server, so
+        that playbin gets their full length, and blocks on data not
+        arrived yet instead of reaching end of stream.
+        '''
+        if not filepath.endswith(Net.PART_EXT):
+            return 'file://' + filepath
+        partial = Net.get_partial_file(filepath)
+        if not partial:
+            # downloaded just now, or stopped
+            song_path = filepath[:-len(Net.PART_EXT)]
+            if os.path.exists(song_path):
+                return 'file://' + song_path
+            return 'file://' + filepath
+        token = secrets.token_urlsafe(16)
+        with stream_files_lock:
+            stream_files[token] = partial
+            while len(stream_files) > STREAM_FILES:
+                stream_files.popitem(last=False)
+        server = get_stream_server()
+        return 'http://127.0.0.1:{0}/{1}'.format(server.server_address[1],
+                                                 token)
+
     def load_audio(self, uri):
         self.set_uri(uri)
         self.disable_bus_sync()
@@ -82,6 +251,8 @@ class PlayerBin(GObject.GObject):
         self.playbin.set_state(Gst.State.PAUSED)
 
     def stop(self):
+        self.next_uri = None
+        self.queued_uri = None
         self.playbin.set_state(Gst.State.NULL)
 
     def get_status(self):
@@ -91,8 +262,19 @@ class PlayerBin(GObject.GObject):
         return self.get_status() == Gst.State.PLAYING
 
     def set_uri(self, uri):
+        self.next_uri = None
+        self.queued_uri = None
         self.playbin.set_property('uri', uri)
 
+    def set_next_uri(self, uri):
+        '''Set uri to play when current one finishes, None to unset.
+
+        It shall be a local file, so that playbin opens it at once, and
+        `track-changed` is emitted when it starts playing. If it is not
+        set in time, `eos` is emitted as before.
+        '''
+        self.next_uri = uri
+
     def get_uri(self):
         return self.playbin.get_property('uri')
 
@@ -205,6 +387,25 @@ class PlayerBin(GObject.GObject):
     def on_eos(self, bus, msg):
         self.emit('eos', True)
 
+    def on_about_to_finish(self, playbin):
+        '''Called in streaming thread, when current uri is almost played.'''
+        uri = self.next_uri
+        if not uri:
+            return
+        self.next_uri = None
+        self.queued_uri = uri
+        playbin.set_property('uri', uri)
+        if GST_LOWER_THAN_1:
+            # no stream-start message in gstreamer 0.10
+            GLib.idle_add(self.on_stream_start, None, None)
+
+    def on_stream_start(self, bus, msg):
+        uri = self.queued_uri
+        if not uri:
+            return
+        self.queued_uri = None
+        self.emit('track-changed', uri)
+
     def on_error(self, bus, msg):
         error_msg = msg.parse_error()
         self.emit('error', error_msg)
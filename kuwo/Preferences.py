@@ -77,6 +77,31 @@ class FontBox(Gtk.Box):
         self.conf[self.font_name] = font_button.get_value()
 
 
+class SpinBox(Gtk.Box):
+    '''Set an integer option in conf.'''
+
+    def __init__(self, label, conf, conf_name, upper, lower=0, step=1,
+                 tooltip=None, use_margin=True):
+        super().__init__()
+        self.conf = conf
+        self.conf_name = conf_name
+        left_label = Gtk.Label(label)
+        self.pack_start(left_label, False, True, 0)
+
+        spin_button = Gtk.SpinButton.new_with_range(lower, upper, step)
+        spin_button.set_value(conf[conf_name])
+        if tooltip:
+            spin_button.set_tooltip_text(tooltip)
+        spin_button.connect('value-changed', self.on_value_set)
+        self.pack_end(spin_button, False, True, 0)
+
+        if use_margin:
+            self.props.margin_left = 20
+
+    def on_value_set(self, spin_button):
+        self.conf[self.conf_name] = spin_button.get_value_as_int()
+
+
 class ChooseFolder(Gtk.Box):
 
     def __init__(self, parent, conf_name, toggle_label):
@@ -260,6 +285,44 @@ class Preferences(Gtk.Dialog):
                                  _('Moving cached MVs to new folder'))
         folder_box.pack_start(mv_folder, False, False, 0)
 
+        # disk cache tab
+        quota_box = NoteTab()
+        notebook.append_page(quota_box, Gtk.Label(_('Disk Cache')))
+
+        quota_label = Widgets.BoldLabel(
+                _('Max size of cached files (MB, 0 means no limit)'))
+        quota_box.pack_start(quota_label, False, False, 0)
+        quotas = (
+            (_('Images'), 'images-quota'),
+            (_('Large images'), 'large-images-quota'),
+            (_('Lyrics'), 'lrc-quota'),
+            (_('Songs'), 'songs-quota'),
+            (_('MVs'), 'mvs-quota'),
+        )
+        for label, quota_name in quotas:
+            quota_box.pack_start(SpinBox(label, app.conf, quota_name,
+                                         1048576, step=16,
+                                         tooltip=_('In MB, 0 means no limit')),
+                                 False, False, 0)
+        quota_tip = Gtk.Label(
+                _('Songs in playlists are never removed from disk'))
+        quota_tip.props.margin_top = MARGIN_TOP
+        quota_tip.props.xalign = 0
+        quota_box.pack_start(quota_tip, False, False, 0)
+
+        cache_jobs_label = Widgets.BoldLabel(_('Cache Service'))
+        cache_jobs_label.props.margin_top = MARGIN_TOP
+        quota_box.pack_start(cache_jobs_label, False, False, 0)
+        cache_jobs = SpinBox(_('Songs downloaded at the same time'),
+                             app.conf, 'cache-jobs', 8, lower=1)
+        quota_box.pack_start(cache_jobs, False, False, 0)
+        bandwidth_limit = SpinBox(
+                _('Max speed of background downloads (KB/s)'), app.conf,
+                'bandwidth-limit', 1048576, step=64,
+                tooltip=_('Songs being played are not limited.\n') +
+                        _('0 means no limit'))
+        quota_box.pack_start(bandwidth_limit, False, False, 0)
+
         self.notebook = notebook
 
         # shortcut tab
@@ -38,11 +38,10 @@ class RadioItem(Gtk.EventBox):
         self.add(self.box)
 
         self.img = Gtk.Image()
-        self.img_path = Net.get_image(self.playlists[self.radio_id]['pic'])
-        self.small_pix = GdkPixbuf.Pixbuf.new_from_file_at_size(self.img_path,
-                                                                50, 50)
-        self.big_pix = GdkPixbuf.Pixbuf.new_from_file_at_size(self.img_path,
-                                                              75, 75)
+        self.small_pix = Config.ANONYMOUS_PIXBUF.scale_simple(
+                50, 50, GdkPixbuf.InterpType.BILINEAR)
+        self.big_pix = Config.ANONYMOUS_PIXBUF.scale_simple(
+                75, 75, GdkPixbuf.InterpType.BILINEAR)
         self.img.set_from_pixbuf(self.small_pix)
         self.box.pack_start(self.img, False, False, 0)
 
@@ -79,7 +78,38 @@ class RadioItem(Gtk.EventBox):
         self.label.hide()
         self.toolbar.hide()
 
+        self.load_images()
         self.init_songs()
+
+    def load_images(self):
+        '''Download and decode radio logo in background thread.'''
+        def _load_images():
+            img_path = Net.get_image(self.playlists[self.radio_id]['pic'],
+                                     size=75)
+            if not img_path:
+                return None
+            big_pix = Net.get_pixbuf(img_path, 75)
+            if not big_pix:
+                return None
+            # scale it down instead of decoding image again
+            small_pix = big_pix.scale_simple(
+                    max(1, big_pix.get_width() * 2 // 3),
+                    max(1, big_pix.get_height() * 2 // 3),
+                    GdkPixbuf.InterpType.BILINEAR)
+            return (small_pix, big_pix)
+
+        def _on_images_loaded(pixs, error=None):
+            if error or not pixs:
+                logger.error('load_images(): %s, %s' % (pixs, error))
+                return
+            self.small_pix, self.big_pix = pixs
+            if self.expanded:
+                self.img.set_from_pixbuf(self.big_pix)
+            else:
+                self.img.set_from_pixbuf(self.small_pix)
+
+        Net.async_call(_load_images, callback=_on_images_loaded,
+                       priority=Net.Priority.THUMBNAIL)
     
     def init_songs(self):
         def _update_songs(songs, error=None):
@@ -103,7 +133,8 @@ class RadioItem(Gtk.EventBox):
         self.playlists[self.radio_id]['offset'] += 1
         Net.async_call(Net.get_radio_songs, self.playlists[self.radio_id],
                        self.playlists[self.radio_id]['offset'],
-                       callback=_on_more_songs_loaded)
+                       callback=_on_more_songs_loaded,
+                       priority=Net.Priority.PREFETCH)
 
     def expand(self):
         if self.expanded:
@@ -153,6 +184,15 @@ class RadioItem(Gtk.EventBox):
         self.playlists[self.radio_id]['curr_song'] += 1
         self.play_song()
 
+    def skip_to_next_song(self):
+        '''Step to next song of this radio, which player already plays.'''
+        self.playlists[self.radio_id]['curr_song'] += 1
+        if self.playlists[self.radio_id]['curr_song'] > 19:
+            self.playlists[self.radio_id]['curr_song'] = 0
+            self.playlists[self.radio_id]['songs'] = \
+                    self.playlists[self.radio_id]['songs'][20:]
+        self.update_label()
+
     def get_next_song(self):
         if self.playlists[self.radio_id]['curr_song'] >= 10:
             self.load_more_songs()
@@ -239,7 +279,8 @@ class Radio(Gtk.Box):
             urls.append(radio['pic'])
         self.liststore_radios.timestamp = time.time()
         Net.async_call(Net.update_liststore_images, self.liststore_radios, 0,
-                       tree_iters, urls)
+                       tree_iters, urls,
+                       priority=Net.Priority.THUMBNAIL)
 
         for radio_rid in self.playlists:
             radio_item = RadioItem(radio_rid, self.app)
@@ -99,7 +99,8 @@ class Themes(Gtk.Box):
                 tree_iters.append(tree_iter)
             self.liststore_main.timestamp = time.time()
             Net.async_call(Net.update_liststore_images, self.liststore_main, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
         Net.async_call(Net.get_themes_main, callback=_on_get_themes)
 
     def on_iconview_main_item_activated(self, iconview, path):
@@ -129,7 +130,8 @@ class Themes(Gtk.Box):
                 tree_iters.append(tree_iter)
                 urls.append(node['pic'])
             Net.async_call(Net.update_liststore_images, self.liststore_sub, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
         if init:
             self.scrolled_main.hide()
             self.scrolled_songs.hide()
@@ -114,7 +114,8 @@ class TopCategories(Gtk.Box):
                 urls.append(node['pic'])
             self.liststore_main.timestamp = time.time()
             Net.async_call(Net.update_liststore_images, self.liststore_main, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
 
         nid = 5
         page = 0
@@ -161,7 +162,8 @@ class TopCategories(Gtk.Box):
                 urls.append(node['pic'])
                 tree_iters.append(tree_iter)
             Net.async_call(Net.update_liststore_images, self.liststore_sub1, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
 
             self.sub1_page += 1
             if self.sub1_page < self.sub1_total - 1:
@@ -219,7 +221,8 @@ class TopCategories(Gtk.Box):
                 urls.append(node['pic'])
                 tree_iters.append(tree_iter)
             Net.async_call(Net.update_liststore_images, self.liststore_sub2, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
 
             self.sub2_page += 1
             if self.sub2_page < self.sub2_total - 1:
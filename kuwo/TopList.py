@@ -82,7 +82,8 @@ class TopList(Gtk.Box):
                 tree_iters.append(tree_iter)
             self.liststore_nodes.timestamp = time.time()
             Net.async_call(Net.update_liststore_images, self.liststore_nodes, 0,
-                           tree_iters, urls)
+                           tree_iters, urls,
+                           priority=Net.Priority.THUMBNAIL)
 
         nid = 2
         page = 0
@@ -7,6 +7,7 @@
 import base64
 import json
 import os
+import re
 import sys
 from urllib import parse
 import subprocess
@@ -84,12 +85,65 @@ def decode_lrc_url(url):
     output = xor_bytes(str_bytes)
     return output.decode('gb18030')
 
+# A single quoted string in Kuwo's pseudo-JSON. Song titles may contain
+# apostrophes, so a quote only ends the string if it is followed by one
+# of `,:}]`. Each alternative matches one character (or one escape pair),
+# a `+` here would backtrack exponentially on an unterminated string.
+_single_quoted = re.compile(r"""'((?:[^'\\]|\\.|'(?!\s*[,:}\]]))*)'""",
+                            re.DOTALL)
+_json_decoder = json.JSONDecoder(strict=False)
+# Escape sequences and double quotes in a single quoted string, escape
+# sequences are taken as pairs, so that `\\` is not split.
+_escape = re.compile(r'\\u[0-9a-fA-F]{4}|\\(.)|\\|"', re.DOTALL)
+
+def _convert_escape(match):
+    token = match.group(0)
+    if token == '"':
+        return '\\"'
+    char = match.group(1)
+    if char is None:
+        # \uXXXX, or a lone backslash at the end
+        if token == '\\':
+            return '\\\\'
+        return token
+    if char == "'":
+        return "'"
+    if char in '\\/"bfnrt':
+        return token
+    # invalid escape in JSON, keep the backslash as a character
+    return '\\\\' + char
+
+def _to_double_quoted(match):
+    value = match.group(1)
+    if '"' in value or '\\' in value:
+        value = _escape.sub(_convert_escape, value)
+    return '"' + value + '"'
+
 def json_loads_single(s):
-    '''Actually this is not a good idea. '''
+    r'''Parse single quoted pseudo-JSON returned by Kuwo.
+
+    Most responses are converted by swapping quotes, which leaves almost
+    all of the work to the C decoder of json module. If that fails, song
+    titles contain apostrophes or escaped quotes, strings are converted
+    one by one with _single_quoted. Control characters in strings are
+    allowed. Returns None if s is invalid, in linear time even if a string
+    is not terminated:
+
+    >>> json_loads_single(r"{'a':'c:\\path', 'b':'it\'s'}")
+    {'a': 'c:\\path', 'b': "it's"}
+    >>> json_loads_single("{'abslist':[{'NAME':'" + 'x' * 100000) is None
+    True
+    '''
+    # Swapping quotes breaks escape sequences.
+    if '\\' not in s:
+        try:
+            return _json_decoder.decode(
+                    s.replace('"', '\\"').replace("'", '"'))
+        except ValueError:
+            pass
     try:
-        return json.loads(
-                s.replace('"', '''\\"''').replace("'", '"').replace('\t', ''))
-    except (ValueError, UnicodeDecodeError):
+        return _json_decoder.decode(_single_quoted.sub(_to_double_quoted, s))
+    except ValueError:
         logger.error(traceback.format_exc())
         return None
 